@@ -0,0 +1,118 @@
+'''In-process read-through cache and conditional GET for backend routes'''
+import time
+import hashlib
+import logging
+import threading
+from functools import wraps
+from flask import request
+from werkzeug.http import quote_etag
+
+
+def row_version_etag(route, versions):
+    '''
+    Strong ETag for a response built from rows whose Postgres xmin
+    values are versions.  Any insert, update or delete of those rows
+    changes the tag.
+    '''
+    digest = hashlib.sha1(route.encode())
+    digest.update(request.query_string)
+    for version in versions:
+        digest.update(b'\0' + str(version).encode())
+    return quote_etag(digest.hexdigest())
+
+
+def not_modified(value):
+    '''
+    Returns a 304 response when the client already holds the ETag
+    carried by value, otherwise value unchanged
+    '''
+    if not isinstance(value, tuple) or len(value) < 3:
+        return value
+    etag = value[2].get("ETag")
+    if etag and request.if_none_match.contains(etag.strip('"')):
+        return ('', 304, {"ETag": etag})
+    return value
+
+
+class ResponseCache:
+    '''
+    Caches route responses keyed by route and query string.
+    Entries expire after ttl seconds or when the route is invalidated
+    by a write.  Each route carries a generation number so a read that
+    raced a write never stores its stale result.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._generations = {}
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(route, query):
+        return (route, tuple(sorted(query.items(multi=True))))
+
+    def get(self, route, query):
+        '''
+        Returns (value, generation).  value is None on a miss, the
+        generation must be handed back to set()
+        '''
+        key = self._key(route, query)
+        with self._lock:
+            generation = self._generations.get(route, 0)
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._hits += 1
+                return entry[1], generation
+            self._entries.pop(key, None)
+            self._misses += 1
+            return None, generation
+
+    def set(self, route, query, value, generation):
+        '''Store value unless route was invalidated since generation'''
+        key = self._key(route, query)
+        with self._lock:
+            if self._generations.get(route, 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, route):
+        '''Drop every cached response for route'''
+        logging.info('Invalidating cached responses for %s', route)
+        with self._lock:
+            self._generations[route] = self._generations.get(route, 0) + 1
+            for key in [k for k in self._entries if k[0] == route]:
+                del self._entries[key]
+
+    def stats(self):
+        '''Snapshot of cache counters'''
+        with self._lock:
+            return {
+                "ttl": self.ttl,
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def cached(self, *statuses):
+        '''
+        Route decorator.  Serves the stored response when present,
+        otherwise runs the view and stores responses whose status is
+        one of statuses.  Responses carrying an ETag the client sent in
+        If-None-Match are answered with 304.
+        '''
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                route = request.path
+                value, generation = self.get(route, request.args)
+                if value is not None:
+                    return not_modified(value)
+                value = view(*args, **kwargs)
+                if isinstance(value, tuple) and value[1] in statuses:
+                    self.set(route, request.args, value, generation)
+                return not_modified(value)
+            return wrapper
+        return decorator
@@ -1,47 +1,56 @@
 '''Serves API endpoints for front to back end interactions'''
 import os
 import time
+import uuid
 import logging
 import json
 import requests
 import psycopg2
 import psycopg2.extras
-from flask import Flask, request
+from psycopg2 import sql as pgsql
+from flask import Flask, Response, request
 from waitress import serve
+from db_pool import ConnectionPool, PoolTimeout
+from api_cache import ResponseCache, row_version_etag
+import reporting
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 
+db_pool = ConnectionPool(
+    minconn=int(os.environ.get('DB_POOL_MIN', '1')),
+    maxconn=int(os.environ.get('DB_POOL_MAX', '8')),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', '5')),
+    check_after=float(os.environ.get('DB_POOL_CHECK_AFTER', '30')),
+    host='postgres-edw',
+    database=os.environ['POSTGRES_DB'],
+    user=os.environ['POSTGRES_USER'],
+    password=os.environ['POSTGRES_PASSWORD']
+)
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+api_cache = ResponseCache(ttl=float(os.environ.get('API_CACHE_TTL', '300')))
 
-def db_connect():
+
+def db_unavailable(error):
     '''
-    Set up database connection
-    Return connection
+    Logs a pool timeout or connection failure
+    Returns a 503 so callers can retry later
     '''
-    logging.info('Connecting to Database')
-    conn = None
-    try:
-        conn = psycopg2.connect(
-            host='postgres-edw',
-            database=os.environ['POSTGRES_DB'],
-            user=os.environ['POSTGRES_USER'],
-            password=os.environ['POSTGRES_PASSWORD']
-        )
-    except psycopg2.OperationalError as error:
-        logging.error(error)
-        return (1)
-    return conn
+    logging.error(error)
+    return ({"message": "Database unavailable"}, 503)
 
 
 def init_settings():
     '''
-    Retrieve DB conn from db_connect()
+    Wait for the DB to accept connections and warm the pool
     Configuration DB tables, if not created
-    Close DB conn
     '''
-    connection = db_connect()
-    while connection == 1:
-        time.sleep(5)
-        connection = db_connect()
+    while True:
+        try:
+            db_pool.fill()
+            break
+        except psycopg2.OperationalError as error:
+            logging.error(error)
+            time.sleep(5)
     logging.info('Initializing Database Tables')
     create_table_sql = """
         CREATE TABLE IF NOT EXISTS reporting.settings (
@@ -52,15 +61,14 @@ def init_settings():
             apisecret VARCHAR(128)
         );
     """
-    with connection:
-        with connection.cursor() as cursor:
-            try:
-                cursor.execute(create_table_sql)
-            except psycopg2.OperationalError as error:
-                logging.error(error)
-                connection.close()
-                return 1
-    connection.close()
+    with db_pool.connection() as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute(create_table_sql)
+                except psycopg2.OperationalError as error:
+                    logging.error(error)
+                    return 1
     return 0
 
 
@@ -101,14 +109,10 @@ def prisma_status():
 @app.post("/api/etljobs")
 def update_etl_jobs():
     '''
-    Creates DB connection then registers new etl jobs
+    Borrows a pooled DB connection then registers new etl jobs
     Receives and inputs etl jobs attributes and returns 201 if created successfully
-    Closes DB connection when finished
+    Returns 503 if no DB connection is available
     '''
-    connection = db_connect()
-    while connection == 1:
-        time.sleep(5)
-        connection = db_connect()
     logging.info('Registering etl job in DB')
     data = json.loads(request.get_json())
     conn_name = data["conn_name"]
@@ -122,21 +126,92 @@ def update_etl_jobs():
         INSERT INTO reporting.etl_jobs (conn_name, conn_since, last_run,
         next_run, elapsed, retention, int_time) VALUES (%s, %s, %s, %s, %s, %s, %s);
     """
-    with connection:
-        with connection.cursor() as cursor:
-            try:
-                cursor.execute(sql, (conn_name, conn_since,
-                                     last_run, next_run, elapsed,
-                                     retention, int_time))
-            except psycopg2.OperationalError as error:
-                logging.error(error)
-                connection.close()
-                return ({"message": error}, 500)
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    try:
+                        cursor.execute(sql, (conn_name, conn_since,
+                                             last_run, next_run, elapsed,
+                                             retention, int_time))
+                        api_cache.invalidate('/api/etljobs')
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    api_cache.invalidate('/api/etljobs')
     logging.info('Successfully added etl job')
-    connection.close()
     return ({"message": "Connection added."}, 201)
 
 
+@app.put("/api/etljobs")
+def update_etl_job_run():
+    '''
+    Updates run statistics of an existing etl job
+    Receives conn_name plus any of next_run, last_run and elapsed
+    Returns 201 if the job was updated, 404 if it is not registered
+    '''
+    data = json.loads(request.get_json())
+    conn_name = data["conn_name"]
+    fields = [f for f in ("next_run", "last_run", "elapsed") if f in data]
+    if not fields:
+        return ({"message": "Nothing to update."}, 400)
+    logging.info('Updating etl job %s - %s', conn_name, ', '.join(fields))
+    sql = pgsql.SQL("UPDATE reporting.etl_jobs SET {} WHERE conn_name = %s").format(
+        pgsql.SQL(', ').join(
+            pgsql.SQL("{} = %s").format(pgsql.Identifier(f)) for f in fields))
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    try:
+                        cursor.execute(
+                            sql, [data[f] for f in fields] + [conn_name])
+                        updated = cursor.rowcount
+                        api_cache.invalidate('/api/etljobs')
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    api_cache.invalidate('/api/etljobs')
+    if not updated:
+        return ({"message": "No such etl job."}, 404)
+    return ({"message": "Connection updated."}, 201)
+
+
+@app.post("/api/etljobs/<conn_name>/run")
+def run_etl_job(conn_name):
+    '''
+    Requests an immediate run of an etl job by moving its next_run to now
+    The etl_jobs_notify trigger wakes the waiting worker
+    Returns 201 if the job was found, 404 otherwise
+    '''
+    logging.info('Requesting immediate run of etl job %s', conn_name)
+    sql = "UPDATE reporting.etl_jobs SET next_run = LOCALTIMESTAMP WHERE conn_name = %s"
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    try:
+                        cursor.execute(sql, (conn_name,))
+                        updated = cursor.rowcount
+                        # Before the commit fires the NOTIFY, so a woken
+                        # worker never reads the cached next_run
+                        api_cache.invalidate('/api/etljobs')
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    # Again after the commit, for reads that raced the first one
+    api_cache.invalidate('/api/etljobs')
+    if not updated:
+        return ({"message": "No such etl job."}, 404)
+    return ({"message": "Run requested."}, 201)
+
+
 @app.post("/api/prismasettings")
 def update_settings():
     '''
@@ -161,104 +236,202 @@ def update_settings():
         FROM reporting.settings
         WHERE type = 'prisma'
     """
-    connection = db_connect()
-    while connection == 1:
-        time.sleep(5)
-        connection = db_connect()
-    with connection:
-        with connection.cursor() as cursor:
-            logging.info('Getting Prisma Cloud settings from DB')
-            try:
-                cursor.execute(get_settings_sql)
-                row = cursor.fetchone()
-                if row:
-                    logging.info('Updating current Prisma Cloud settings')
-                    try:
-                        cursor.execute(update_pc_settings,
-                                       (pc_url, pc_key, pc_secret))
-                    except psycopg2.OperationalError as error:
-                        logging.error(error)
-                        connection.close()
-                        return ({"message": error}, 500)
-                else:
-                    logging.info('Add new Prisma Cloud settings')
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    logging.info('Getting Prisma Cloud settings from DB')
                     try:
-                        cursor.execute(add_pc_settings, ('prisma',
-                                                         pc_url, pc_key, pc_secret,))
+                        cursor.execute(get_settings_sql)
+                        row = cursor.fetchone()
+                        if row:
+                            logging.info(
+                                'Updating current Prisma Cloud settings')
+                            cursor.execute(update_pc_settings,
+                                           (pc_url, pc_key, pc_secret))
+                        else:
+                            logging.info('Add new Prisma Cloud settings')
+                            cursor.execute(add_pc_settings, ('prisma',
+                                                             pc_url, pc_key, pc_secret,))
                     except psycopg2.OperationalError as error:
                         logging.error(error)
-                        connection.close()
-                        return ({"message": error}, 500)
-            except psycopg2.OperationalError as error:
-                logging.error(error)
-                connection.close()
-                return ({"message": error}, 500)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    api_cache.invalidate('/api/prismasettings')
     logging.info('Successfully entered Prisma Cloud settings')
-    connection.close()
     return ({"message": "Prisma Cloud settings successful."}, 201)
 
 
 @app.get("/api/prismasettings")
+@api_cache.cached(201, 204)
 def get_settings():
     '''
     Returns Prisma Cloud Settings from the DB
+    ETag follows the settings row version, If-None-Match gets a 304
     '''
-    connection = db_connect()
-    while connection == 1:
-        time.sleep(5)
-        connection = db_connect()
     logging.info('Retrieving Prisma Cloud Settings from DB')
-    with connection:
-        with connection.cursor() as cursor:
-            get_settings_sql = """
-                SELECT apiurl, apikey, apisecret
-                FROM reporting.settings
-                WHERE type = 'prisma'
-            """
-            try:
-                cursor.execute(get_settings_sql)
-            except psycopg2.OperationalError as error:
-                logging.error(error)
-                return ({"message": error}, 500)
-            row = cursor.fetchone()
-            if row:
-                logger.info('Prisma Cloud settings found and returned')
-                return ({"apiurl": row[0], "apikey": row[1], "apisecret": row[2]}, 201)
-            logger.info('No Prisma Cloud settings found in DB')
-            return ('', 204)
+    get_settings_sql = """
+        SELECT apiurl, apikey, apisecret, xmin::text
+        FROM reporting.settings
+        WHERE type = 'prisma'
+    """
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    try:
+                        cursor.execute(get_settings_sql)
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+                    row = cursor.fetchone()
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    if row:
+        logging.info('Prisma Cloud settings found and returned')
+        return ({"apiurl": row[0], "apikey": row[1], "apisecret": row[2]}, 201,
+                {"ETag": row_version_etag(request.path, [row[3]])})
+    logging.info('No Prisma Cloud settings found in DB')
+    return ('', 204)
 
 
 @app.get("/api/etljobs")
+@api_cache.cached(201, 204)
 def get_etl_jobs():
     '''
     Get etl jobs from DB and return
+    ETag follows the job row versions, If-None-Match gets a 304
     '''
     args = request.args
     etl_name = args.get('etl_name')
-    connection = db_connect()
-    while connection == 1:
-        time.sleep(5)
-        connection = db_connect()
     logging.info('Getting etl job listing matching etl name from DB')
-    with connection:
-        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            if etl_name is None:
-                sql = "SELECT * FROM reporting.etl_jobs"
-            else:
-                sql = """SELECT * FROM reporting.etl_jobs
-                    WHERE conn_name = \'""" + etl_name + "\'"
-            try:
-                cursor.execute(sql)
-                records = cursor.fetchall()
-            except psycopg2.OperationalError as error:
-                logging.error(error)
-                connection.close()
-                return ({"message": error}, 500)
-            if records:
-                logging.info('Found and returning registered etl jobs')
-                return records, 201
-            logging.info('No registered etl jobs found')
-            return '', 204
+    if etl_name is None:
+        sql = """SELECT xmin::text AS row_version, * FROM reporting.etl_jobs
+            ORDER BY conn_name, conn_since"""
+        params = None
+    else:
+        sql = """SELECT xmin::text AS row_version, * FROM reporting.etl_jobs
+            WHERE conn_name = %s ORDER BY conn_since"""
+        params = (etl_name,)
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    try:
+                        cursor.execute(sql, params)
+                        records = cursor.fetchall()
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    if records:
+        logging.info('Found and returning registered etl jobs')
+        versions = [record.pop('row_version') for record in records]
+        return records, 201, {"ETag": row_version_etag(request.path, versions)}
+    logging.info('No registered etl jobs found')
+    return '', 204
+
+
+@app.get("/api/reporting/<dataset>")
+def get_reporting_page(dataset):
+    '''
+    Returns one page of reporting.defenders or reporting.coverage rows
+    Filters, sort and cursor are taken from the query string, see
+    reporting.page_query.  Follow next_cursor for the next page.
+    Coverage kept as history (COVERAGE_STORAGE=diff) is not served.
+    '''
+    if reporting.unsupported(dataset):
+        return ({"message": reporting.unsupported(dataset)}, 404)
+    try:
+        query, params, columns, sort_column, limit = reporting.page_query(
+            dataset, request.args)
+    except KeyError:
+        return ({"message": "Unknown dataset."}, 404)
+    except ValueError as error:
+        return ({"message": str(error)}, 400)
+    logging.info('Reading %s page from DB', dataset)
+    try:
+        with db_pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    try:
+                        cursor.execute(query, params)
+                        rows = cursor.fetchall()
+                    except psycopg2.ProgrammingError as error:
+                        logging.error(error)
+                        return ({"message": "Dataset not available."}, 404)
+                    except psycopg2.DataError as error:
+                        logging.error(error)
+                        return ({"message": "Invalid filter or cursor."}, 400)
+                    except psycopg2.OperationalError as error:
+                        logging.error(error)
+                        return ({"message": str(error)}, 500)
+    except (PoolTimeout, psycopg2.OperationalError) as error:
+        return db_unavailable(error)
+    return (reporting.page_body(rows, columns, sort_column, limit), 200)
+
+
+@app.get("/api/export/<dataset>")
+def export_reporting(dataset):
+    '''
+    Streams every reporting.defenders or reporting.coverage row matching
+    the filters as CSV (default) or NDJSON, as a .gz file when gzip=true
+    Rows come from a server-side cursor EXPORT_BATCH_SIZE at a time so
+    memory stays flat regardless of the export size
+    The pooled connection is borrowed once streaming starts, a pool
+    timeout then ends the response early instead of returning a 503
+    Coverage kept as history (COVERAGE_STORAGE=diff) is not served.
+    '''
+    if reporting.unsupported(dataset):
+        return ({"message": reporting.unsupported(dataset)}, 404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in reporting.EXPORT_FORMATS:
+        return ({"message": "Unknown export format."}, 400)
+    try:
+        compress = reporting.parse_bool(request.args.get('gzip', 'false'))
+        query, params, columns = reporting.export_query(dataset, request.args)
+    except KeyError:
+        return ({"message": "Unknown dataset."}, 404)
+    except ValueError as error:
+        return ({"message": str(error)}, 400)
+
+    def batches():
+        try:
+            with db_pool.connection() as connection:
+                with connection.cursor(name='export_' + uuid.uuid4().hex) as cursor:
+                    cursor.itersize = EXPORT_BATCH_SIZE
+                    cursor.execute(query, params)
+                    while True:
+                        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                        if not rows:
+                            break
+                        yield rows
+        except (PoolTimeout, psycopg2.Error) as error:
+            logging.error(error)
+            raise
+        finally:
+            logging.info('Finished %s export', dataset)
+
+    logging.info('Starting %s export as %s', dataset, fmt)
+    filename = "%s.%s" % (dataset, fmt)
+    mimetype = reporting.EXPORT_FORMATS[fmt]
+    if compress:
+        # A gzip file, not a gzip transfer encoding clients would undo
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(reporting.encode_export(batches(), columns, fmt, compress),
+                    mimetype=mimetype,
+                    headers={"Content-Disposition": "attachment; filename=%s" % filename})
+
+
+@app.get("/api/metrics")
+def get_metrics():
+    '''
+    Returns DB connection pool and response cache counters
+    '''
+    return ({"db_pool": db_pool.stats(), "cache": api_cache.stats()}, 200)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,183 @@
+'''Bounded, thread-safe Postgres connection pool shared by the API routes'''
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    '''Raised when no connection could be acquired before the timeout'''
+
+
+class ConnectionPool:
+    '''
+    Hands out at most maxconn psycopg2 connections.
+    Idle connections are health checked before reuse, broken ones are
+    discarded and replaced.  Callers that cannot get a connection
+    within timeout seconds receive PoolTimeout instead of blocking.
+    '''
+
+    def __init__(self, minconn, maxconn, timeout, check_after, **params):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.params = params
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._discarded = 0
+        self._timeouts = 0
+        self._cond = threading.Condition()
+
+    def _create(self):
+        '''Open a new connection, the slot must already be reserved'''
+        logging.info('Connecting to Database')
+        try:
+            conn = psycopg2.connect(**self.params)
+        except psycopg2.Error:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        '''
+        Returns False for closed connections, and for connections idle
+        longer than check_after that fail a round trip to the server
+        '''
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error as error:
+            logging.error(error)
+            return False
+        return True
+
+    def _close(self, conn):
+        '''Close a connection and release its slot'''
+        try:
+            conn.close()
+        except psycopg2.Error as error:
+            logging.error(error)
+        with self._cond:
+            self._open -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def fill(self):
+        '''Open connections until minconn are idle in the pool'''
+        while True:
+            with self._cond:
+                if self._open >= max(self.minconn, 1) or self._open >= self.maxconn:
+                    return
+                self._open += 1
+            conn = self._create()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout=None):
+        '''
+        Return a healthy connection from the pool.
+        Raises PoolTimeout if none frees up within timeout seconds,
+        psycopg2.OperationalError if a new connection cannot be opened.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                self._waiting += 1
+                try:
+                    while not self._idle and self._open >= self.maxconn:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._timeouts += 1
+                            raise PoolTimeout(
+                                'No database connection available after %ss' % timeout)
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn, idle_since = None, None
+                    self._open += 1
+            if conn is None:
+                conn = self._create()
+            elif not self._healthy(conn, idle_since):
+                logging.info('Discarding broken database connection')
+                self._close(conn)
+                continue
+            with self._cond:
+                self._in_use += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        '''
+        Return a connection to the pool.  Connections left inside a
+        transaction are rolled back, unusable ones are discarded.
+        '''
+        with self._cond:
+            self._in_use -= 1
+        if not discard and not conn.closed:
+            status = conn.info.transaction_status
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error as error:
+                    logging.error(error)
+                    discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''Borrow a connection for the duration of a with block'''
+        conn = self.getconn(timeout)
+        discard = False
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard)
+
+    def stats(self):
+        '''Snapshot of pool counters'''
+        with self._cond:
+            return {
+                "max": self.maxconn,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "created": self._created,
+                "discarded": self._discarded,
+                "timeouts": self._timeouts,
+            }
+
+    def closeall(self):
+        '''Close every idle connection'''
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
@@ -0,0 +1,262 @@
+'''Filtered, paginated and streamed reads of the reporting fact tables'''
+import os
+import io
+import csv
+import json
+import zlib
+import base64
+from datetime import date
+from psycopg2 import sql as pgsql
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+# With COVERAGE_STORAGE=diff the coverage ETL keeps reporting.coverage_history
+# instead of filling reporting.coverage, see reporting.coverage_asof(date)
+COVERAGE_STORAGE = os.environ.get('COVERAGE_STORAGE', 'snapshot')
+
+DATASETS = {
+    "defenders": {
+        "table": "defenders",
+        "columns": ["hostname", "version", "type", "category", "connected",
+                    "accountid", "date_added"],
+        "nullable": [],
+        "filters": {"accountID": "accountid", "version": "version",
+                    "category": "category"},
+    },
+    "coverage": {
+        "table": "coverage",
+        "columns": ["provider", "service", "region", "registry", "credential",
+                    "accountid", "name", "vminstance", "defended", "runtime",
+                    "version", "date_added"],
+        "nullable": ["accountid", "name", "vminstance", "runtime", "version"],
+        "filters": {"accountID": "accountid", "version": "version",
+                    "provider": "provider", "region": "region",
+                    "defended": "defended"},
+    },
+}
+
+
+def unsupported(name):
+    '''
+    Reason the rows of dataset name cannot be served, None if they can.
+    Row reads page on reporting.coverage ids, which history storage
+    does not have.
+    '''
+    if name == 'coverage' and COVERAGE_STORAGE == 'diff':
+        return ('Coverage is stored as history (COVERAGE_STORAGE=diff), '
+                'query reporting.coverage_asof(date) instead.')
+    return None
+
+
+def parse_bool(value):
+    '''Parses true/false style query values'''
+    if value.lower() in ('true', 't', '1', 'yes'):
+        return True
+    if value.lower() in ('false', 'f', '0', 'no'):
+        return False
+    raise ValueError('Invalid boolean value: %s' % value)
+
+
+def parse_date(value):
+    '''Parses YYYY-MM-DD query values'''
+    try:
+        return date.fromisoformat(value)
+    except ValueError as error:
+        raise ValueError('Invalid date: %s' % value) from error
+
+
+def encode_cursor(values):
+    '''Opaque cursor holding the sort key of the last row on a page'''
+    payload = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Inverse of encode_cursor'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError as error:
+        raise ValueError('Invalid cursor') from error
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def filter_clauses(dataset, args):
+    '''
+    Builds WHERE conditions and parameters from the filter arguments.
+    Repeating a filter argument matches any of its values.
+    date_from and date_to bound date_added inclusively.
+    '''
+    conditions = []
+    params = []
+    for arg, column in dataset["filters"].items():
+        values = args.getlist(arg)
+        if not values:
+            continue
+        if column == "defended":
+            values = [parse_bool(v) for v in values]
+        conditions.append(pgsql.SQL("{} = ANY(%s)").format(
+            pgsql.Identifier(column)))
+        params.append(values)
+    if args.get('date_from'):
+        conditions.append(pgsql.SQL("date_added >= %s"))
+        params.append(parse_date(args['date_from']))
+    if args.get('date_to'):
+        conditions.append(pgsql.SQL("date_added <= %s"))
+        params.append(parse_date(args['date_to']))
+    return conditions, params
+
+
+def where_clause(conditions):
+    '''Joins conditions into a WHERE clause, empty without conditions'''
+    if not conditions:
+        return pgsql.SQL("")
+    return pgsql.SQL(" WHERE ") + pgsql.SQL(" AND ").join(conditions)
+
+
+def sort_key(dataset, args):
+    '''
+    Returns the sort column, its SQL expression and direction.
+    sort=column sorts ascending, sort=-column descending, id breaks ties.
+    '''
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    column = sort.lstrip('-')
+    if column != 'id' and column not in dataset["columns"]:
+        raise ValueError('Cannot sort by %s' % column)
+    expression = pgsql.Identifier(column)
+    if column in dataset["nullable"]:
+        expression = pgsql.SQL("COALESCE({}, '')").format(expression)
+    return column, expression, descending
+
+
+def page_query(name, args):
+    '''
+    Builds the parameterized query for one page of dataset name.
+    Returns the query, its parameters, the selected columns, the sort
+    column and the page size.  Raises ValueError on bad arguments.
+    '''
+    if name not in DATASETS:
+        raise KeyError(name)
+    dataset = DATASETS[name]
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError('limit must be between 1 and %s' % MAX_LIMIT)
+    conditions, params = filter_clauses(dataset, args)
+    column, expression, descending = sort_key(dataset, args)
+    if args.get('cursor'):
+        last_value, last_id = decode_cursor(args['cursor'])
+        if column == 'id':
+            conditions.append(pgsql.SQL("id {} %s").format(
+                pgsql.SQL('<' if descending else '>')))
+            params.append(last_id)
+        else:
+            conditions.append(pgsql.SQL("({}, id) {} (%s, %s)").format(
+                expression, pgsql.SQL('<' if descending else '>')))
+            params.extend([last_value, last_id])
+    direction = pgsql.SQL('DESC' if descending else 'ASC')
+    order = [pgsql.SQL("id {}").format(direction)]
+    if column != 'id':
+        order.insert(0, pgsql.SQL("{} {}").format(expression, direction))
+    query = pgsql.SQL(
+        "SELECT {columns}, id FROM reporting.{table}{where} ORDER BY {order} LIMIT %s"
+    ).format(
+        columns=pgsql.SQL(', ').join(
+            pgsql.Identifier(c) for c in dataset["columns"]),
+        table=pgsql.Identifier(dataset["table"]),
+        where=where_clause(conditions),
+        order=pgsql.SQL(', ').join(order),
+    )
+    params.append(limit + 1)
+    return query, params, dataset["columns"], column, limit
+
+
+def page_body(rows, columns, sort_column, limit):
+    '''
+    Compact page of column names plus row arrays.  next_cursor is set
+    when more rows follow and is passed back as the cursor argument.
+    '''
+    more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if more:
+        last = rows[-1]
+        sort_value = last[-1] if sort_column == 'id' else last[columns.index(sort_column)]
+        if sort_value is None:
+            sort_value = ''
+        next_cursor = encode_cursor([sort_value, last[-1]])
+    return {
+        "columns": columns,
+        "rows": [[v.isoformat() if isinstance(v, date) else v for v in row[:-1]]
+                 for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def export_query(name, args):
+    '''
+    Builds the parameterized query behind a full export of dataset
+    name, filtered like page_query but without paging.
+    Returns the query, its parameters and the selected columns.
+    '''
+    if name not in DATASETS:
+        raise KeyError(name)
+    dataset = DATASETS[name]
+    conditions, params = filter_clauses(dataset, args)
+    query = pgsql.SQL(
+        "SELECT {columns} FROM reporting.{table}{where} ORDER BY id"
+    ).format(
+        columns=pgsql.SQL(', ').join(
+            pgsql.Identifier(c) for c in dataset["columns"]),
+        table=pgsql.Identifier(dataset["table"]),
+        where=where_clause(conditions),
+    )
+    return query, params, dataset["columns"]
+
+
+def csv_chunk(rows, header=None):
+    '''Renders rows, preceded by an optional header, as CSV text'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def ndjson_chunk(rows, columns):
+    '''Renders rows as one JSON object per line'''
+    return ''.join(
+        json.dumps(dict(zip(columns, row)), default=str, separators=(',', ':')) + '\n'
+        for row in rows)
+
+
+def encode_export(batches, columns, fmt, compress):
+    '''
+    Turns an iterator of row batches into encoded response chunks.
+    Only one batch is held at a time, gzip output is flushed per batch.
+    '''
+    gzipper = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    first = True
+    for rows in batches:
+        if fmt == "csv":
+            text = csv_chunk(rows, columns if first else None)
+        else:
+            text = ndjson_chunk(rows, columns)
+        first = False
+        data = text.encode()
+        if gzipper:
+            data = gzipper.compress(data) + gzipper.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    if first and fmt == "csv":
+        data = csv_chunk([], columns).encode()
+        yield gzipper.compress(data) + gzipper.flush() if gzipper else data
+    elif gzipper:
+        yield gzipper.flush()
@@ -0,0 +1,73 @@
+'''
+Benchmark of redis cache payloads for the coverage dataframe.
+
+Compares payload size and encode/decode time of the pickled frame
+previously written through DirectRedis with the Arrow IPC format of
+df_cache, on synthetic coverage frames.
+
+    pip install -r requirements.txt
+    python benchmarks/bench_cache_format.py
+'''
+import os
+import sys
+import time
+import pickle
+import random
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from df_cache import encode_frame, decode_frame  # noqa: E402
+
+SIZES = [100000, 500000]
+
+
+def make_coverage(count):
+    '''Synthetic frame shaped like curr_coverage'''
+    rng = random.Random(count)
+    providers = ['aws', 'azure', 'gcp']
+    services = ['aws-ec2', 'aws-eks', 'aws-lambda', 'azure-vm', 'gcp-gke']
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'eastus', 'us-central1']
+    accounts = [str(rng.randrange(10 ** 11, 10 ** 12)) for _ in range(200)]
+    return pd.DataFrame({
+        'Provider': [rng.choice(providers) for _ in range(count)],
+        'Service Type': [rng.choice(services) for _ in range(count)],
+        'Region': [rng.choice(regions) for _ in range(count)],
+        'Registry': ['registry-%s' % rng.randrange(50) for _ in range(count)],
+        'Credential': ['cred-%s' % rng.randrange(20) for _ in range(count)],
+        'Account ID': [rng.choice(accounts) for _ in range(count)],
+        'Name': ['resource-%s' % i for i in range(count)],
+        'VM Instance': ['i-%012x' % rng.getrandbits(48) for _ in range(count)],
+        'Defended': [rng.random() > 0.3 for _ in range(count)],
+        'Runtime': [rng.choice(['docker', 'containerd', None]) for _ in range(count)],
+        'Version': [rng.choice(['22.12.582', '22.06.197', None]) for _ in range(count)],
+        'date_added': '2023-01-01',
+    })
+
+
+def measure(encode, decode, df):
+    start = time.perf_counter()
+    payload = encode(df)
+    encoded = time.perf_counter()
+    decode(payload)
+    decoded = time.perf_counter()
+    return len(payload), encoded - start, decoded - encoded
+
+
+def main():
+    formats = [
+        ('pickle', pickle.dumps, pickle.loads),
+        ('arrow-zstd', lambda df: encode_frame(df, 'zstd'), decode_frame),
+        ('arrow-lz4', lambda df: encode_frame(df, 'lz4'), decode_frame),
+    ]
+    print('%8s %12s %12s %12s %12s' % (
+        'rows', 'format', 'size (MB)', 'encode (s)', 'decode (s)'))
+    for size in SIZES:
+        df = make_coverage(size)
+        for name, encode, decode in formats:
+            nbytes, encode_time, decode_time = measure(encode, decode, df)
+            print('%8s %12s %12.2f %12.3f %12.3f' % (
+                size, name, nbytes / 2 ** 20, encode_time, decode_time))
+
+
+if __name__ == "__main__":
+    main()
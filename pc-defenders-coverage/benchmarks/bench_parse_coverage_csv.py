@@ -0,0 +1,94 @@
+'''
+Benchmark of parsing the cloud discovery CSV.
+
+Compares the previous full parse followed by twelve column drops with
+read_coverage_csv on a synthetic 500k-row download, reporting parse
+time, peak traced memory and the memory of the resulting frame.
+
+    pip install -r requirements.txt
+    python benchmarks/bench_parse_coverage_csv.py
+'''
+import io
+import os
+import sys
+import time
+import random
+import logging
+import tracemalloc
+import pandas as pd
+
+os.environ.setdefault('POSTGRES_USER', 'bench')
+os.environ.setdefault('POSTGRES_PASSWORD', 'bench')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from app import read_coverage_csv, DROPPED_COLUMNS  # noqa: E402
+
+ROWS = 500000
+HEADER = [
+    'Provider', 'Service Type', 'Region', 'Registry', 'Credential', 'Account ID',
+    'Name', 'VM Instance', 'Defended', 'Runtime', 'Version', 'Project',
+    'Image ID', 'FQDN', 'Resource Group', 'Running Tasks', 'Active Services',
+    'ARN', 'Last Modified', 'Created At', 'Additional Data', 'Status', 'Nodes'
+]
+
+
+def make_csv(count):
+    '''Synthetic discovery download shaped like the real one'''
+    rng = random.Random(count)
+    providers = ['aws', 'azure', 'gcp']
+    services = ['aws-ec2', 'aws-eks', 'aws-lambda', 'azure-vm', 'gcp-gke']
+    regions = ['us-east-1', 'us-west-2', 'eu-west-1', 'eastus', 'us-central1']
+    accounts = ['%012d' % rng.randrange(10 ** 11) for _ in range(200)]
+    lines = [','.join(HEADER)]
+    for i in range(count):
+        account = rng.choice(accounts)
+        lines.append(','.join([
+            rng.choice(providers), rng.choice(services), rng.choice(regions),
+            'registry-%s' % rng.randrange(50), 'cred-%s' % rng.randrange(20),
+            account, 'resource-%s' % i, 'i-%012x' % rng.getrandbits(48),
+            rng.choice(['true', 'false']), rng.choice(['docker', 'containerd', '']),
+            rng.choice(['22.12.582', '22.06.197', '']), 'project-%s' % rng.randrange(30),
+            'ami-%012x' % rng.getrandbits(48), 'host-%s.example.com' % i,
+            'rg-%s' % rng.randrange(40), str(rng.randrange(10)), str(rng.randrange(10)),
+            'arn:aws:ec2:us-east-1:%s:instance/i-%012x' % (account, rng.getrandbits(48)),
+            '2023-01-01T00:00:00Z', '2022-06-01T00:00:00Z',
+            '"{""tags"": ""team-%s"", ""owner"": ""user-%s""}"' % (
+                rng.randrange(20), rng.randrange(500)),
+            rng.choice(['running', 'stopped']), str(rng.randrange(5)),
+        ]))
+    return '\n'.join(lines) + '\n'
+
+
+def legacy_parse(text):
+    '''The full parse and drops previously in get_coverage_df'''
+    coverage_df = pd.read_csv(filepath_or_buffer=io.StringIO(text))
+    for column in sorted(DROPPED_COLUMNS):
+        coverage_df.drop(column, axis=1, inplace=True)
+    return coverage_df
+
+
+def pruned_parse(text):
+    return read_coverage_csv(io.StringIO(text))
+
+
+def measure(parse, text):
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = parse(text)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, df.memory_usage(deep=True).sum()
+
+
+def main():
+    logging.disable(logging.WARNING)
+    text = make_csv(ROWS)
+    print('%d rows, %.1f MB of CSV' % (ROWS, len(text) / 2 ** 20))
+    print('%8s %10s %16s %14s' % ('parse', 'time (s)', 'peak traced (MB)', 'frame (MB)'))
+    for name, parse in [('legacy', legacy_parse), ('pruned', pruned_parse)]:
+        elapsed, peak, size = measure(parse, text)
+        print('%8s %10.2f %16.1f %14.1f' % (name, elapsed, peak / 2 ** 20, size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,22 +9,48 @@
 from datetime import datetime, timedelta
 from time import mktime
 import os
-import io
-from io import StringIO
 import sys
 import time
 import logging
 import json
+import csv
 import pandas as pd
+from pandas.api.types import union_categoricals
 import psycopg2
+from psycopg2 import sql as pgsql
 import requests
-from direct_redis import DirectRedis
+import redis
 from prismacloud.api import pc_api
+from scheduler import Scheduler, NOTIFY_SQL
+from df_cache import publish_frame
+from copy_loader import copy_frame
+from partitions import (ensure_partitioned, ensure_partitions, clear_partition,
+                        drop_partitions_before)
 
 logging.basicConfig(
     format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
 
 ETL_NAME = 'defenders_coverage'
+COVERAGE_COLUMNS = [
+    'provider', 'service', 'region', 'registry', 'credential', 'accountid',
+    'name', 'vminstance', 'defended', 'runtime', 'version', 'date_added'
+]
+# NOT NULL text columns, a blank value loads as ''
+COVERAGE_NOT_NULL = ['provider', 'service', 'region', 'registry', 'credential']
+COVERAGE_DDL = '''
+    provider varchar (16) NOT NULL,
+    service varchar (24) NOT NULL,
+    region varchar (24) NOT NULL,
+    registry varchar (128) NOT NULL,
+    credential varchar (64) NOT NULL,
+    accountID varchar (64),
+    name varchar (256),
+    vminstance varchar (256),
+    defended boolean NOT NULL,
+    runtime varchar (16),
+    version varchar (16),
+    date_added DATE NOT NULL
+'''
 BACKEND_API = 'http://backend-api:5050'
 REDIS_CACHE = 'redis-cache'
 RETENTION = 35
@@ -36,15 +62,38 @@ DB_SETTINGS = {
     "user":     os.environ['POSTGRES_USER'],
     "password": os.environ['POSTGRES_PASSWORD'],
 }
-
-
-def db_write(conn, sql):
+HTTP_CACHE = {}
+DROPPED_COLUMNS = {
+    'Project', 'Image ID', 'FQDN', 'Resource Group', 'Running Tasks',
+    'Active Services', 'ARN', 'Last Modified', 'Created At',
+    'Additional Data', 'Status', 'Nodes'
+}
+COVERAGE_DTYPES = {
+    'provider': 'category', 'service': 'category', 'region': 'category',
+    'registry': str, 'credential': str, 'accountid': str, 'name': str,
+    'vminstance': str, 'runtime': 'category', 'version': 'category'
+}
+COVERAGE_STORAGE = os.environ.get('COVERAGE_STORAGE', 'snapshot')
+HISTORY_KEY_COLUMNS = [
+    'provider', 'service', 'region', 'registry', 'credential', 'accountid',
+    'name', 'vminstance'
+]
+SUMMARY_KEYS = ['provider', 'service', 'region', 'accountid', 'runtime']
+SUMMARY_COLUMNS = ['date_added'] + SUMMARY_KEYS + ['total', 'defended']
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/tmp/spool')
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', '6'))
+DOWNLOAD_BACKOFF = 5
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '100000'))
+
+
+def db_write(conn, sql, params=None):
     """Uses received db connection and executes received sql"""
     logging.info('DB Write - %s', sql)
     cursor = conn.cursor()
     try:
-        cursor.execute(sql)
-    except requests.exceptions.RequestException as error:
+        cursor.execute(sql, params)
+    except psycopg2.Error as error:
         conn.rollback()
         cursor.close()
         logging.error(error)
@@ -59,8 +108,19 @@ def init_coverage(conn):
     Initializing required tables for etl job
     '''
     logging.info('Initializing DB tables - coverage, etl_jobs')
+    partitioned = ensure_partitioned(conn, 'coverage', COVERAGE_DDL, COVERAGE_COLUMNS)
     sql = '''
-    CREATE TABLE IF NOT EXISTS reporting.coverage (
+        CREATE TABLE IF NOT EXISTS reporting.etl_jobs (
+        conn_name varchar (128) NOT NULL,
+        conn_since TIMESTAMP NOT null,
+        last_run TIMESTAMP NOT null,
+        elapsed VARCHAR(8) NOT null,
+        next_run TIMESTAMP NOT null,
+        retention INT NOT null,
+        int_time INT
+    );
+    CREATE TABLE IF NOT EXISTS reporting.coverage_history (
+        resource_key char (32) NOT NULL,
         provider varchar (16) NOT NULL,
         service varchar (24) NOT NULL,
         region varchar (24) NOT NULL,
@@ -72,20 +132,42 @@ def init_coverage(conn):
         defended boolean NOT NULL,
         runtime varchar (16),
         version varchar (16),
-        date_added DATE NOT NULL
+        valid_from DATE NOT NULL,
+        valid_to DATE
     );
-        CREATE TABLE IF NOT EXISTS reporting.etl_jobs (
-        conn_name varchar (128) NOT NULL,
-        conn_since TIMESTAMP NOT null,
-        last_run TIMESTAMP NOT null,
-        elapsed VARCHAR(8) NOT null,
-        next_run TIMESTAMP NOT null,
-        retention INT NOT null,
-        int_time INT
+    ALTER TABLE reporting.coverage_history
+        ADD COLUMN IF NOT EXISTS copies INT NOT NULL DEFAULT 1;
+    CREATE UNIQUE INDEX IF NOT EXISTS coverage_history_current_idx
+        ON reporting.coverage_history (resource_key) WHERE valid_to IS NULL;
+    CREATE INDEX IF NOT EXISTS coverage_history_valid_idx
+        ON reporting.coverage_history (valid_from, valid_to);
+    CREATE OR REPLACE FUNCTION reporting.coverage_asof(snapshot_date DATE)
+    RETURNS TABLE (
+        provider varchar, service varchar, region varchar, registry varchar,
+        credential varchar, accountID varchar, name varchar, vminstance varchar,
+        defended boolean, runtime varchar, version varchar, date_added DATE
+    ) AS $$
+        SELECT provider, service, region, registry, credential, accountID,
+            name, vminstance, defended, runtime, version, snapshot_date
+        FROM reporting.coverage_history, generate_series(1, copies)
+        WHERE valid_from <= snapshot_date
+            AND (valid_to IS NULL OR valid_to > snapshot_date)
+    $$ LANGUAGE sql STABLE;
+    CREATE TABLE IF NOT EXISTS reporting.coverage_summary (
+        date_added DATE NOT NULL,
+        provider varchar (16) NOT NULL,
+        service varchar (24) NOT NULL,
+        region varchar (24) NOT NULL,
+        accountID varchar (64),
+        runtime varchar (16),
+        total INT NOT NULL,
+        defended INT NOT NULL
     );
+    CREATE INDEX IF NOT EXISTS coverage_summary_date_added_idx
+        ON reporting.coverage_summary (date_added);
     GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA reporting TO prisma;
     '''
-    if db_write(conn, sql):
+    if partitioned and db_write(conn, sql) and db_write(conn, NOTIFY_SQL):
         logging.info('...success')
     else:
         logging.info('...failed')
@@ -103,15 +185,21 @@ def db_connect(params_dict):
     return l_conn
 
 
+def db_connect_retry(params_dict):
+    """Creates and returns postgres connection, retrying every 5 seconds"""
+    conn = db_connect(params_dict)
+    while conn == 1:
+        time.sleep(5)
+        conn = db_connect(params_dict)
+    return conn
+
+
 def init_db():
     '''
     Connects to db with retry
     Inits DB tables, if not created
     '''
-    conn = db_connect(DB_SETTINGS)
-    while conn == 1:
-        time.sleep(5)
-        conn = db_connect(DB_SETTINGS)
+    conn = db_connect_retry(DB_SETTINGS)
     init_coverage(conn)
     logging.info('Closing DB Connection')
     conn.close()
@@ -121,7 +209,7 @@ def init_db():
 def add_etl_job():
     '''
     No ETL job for ETL_NAME found in DB.
-    Add ETL job to DB.
+    Add ETL job to DB.  Returns None when the backend is unavailable.
     '''
     url = BACKEND_API + "/api/etljobs"
     curr_time = datetime.now()
@@ -136,6 +224,9 @@ def add_etl_job():
         response = requests.post(url, json=data, timeout=10)
     except requests.exceptions.RequestException as error:
         logging.error(error)
+        return None
+    if response.status_code == 503:
+        return None
     if response.status_code != 201:
         logging.error('Could not configure ETL attributes')
         sys.exit(500)
@@ -168,32 +259,63 @@ def validate_pc_creds(api_url, api_key, api_secret):
         return False
 
 
+def conditional_get(url):
+    '''
+    GET url sending If-None-Match with the last ETag seen for it.
+    A 304 replays the status and parsed body stored with that ETag,
+    so unchanged responses are neither downloaded nor re-parsed.
+    Returns status code and parsed json (None for an empty body).
+    '''
+    headers = {}
+    cached = HTTP_CACHE.get(url)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    response = requests.get(url, headers=headers, timeout=10)
+    if response.status_code == 304 and cached:
+        logging.info('%s not modified, reusing last response', url)
+        return cached[1], cached[2]
+    body = response.json() if response.text != '' else None
+    etag = response.headers.get('ETag')
+    if etag:
+        HTTP_CACHE[url] = (etag, response.status_code, body)
+    else:
+        HTTP_CACHE.pop(url, None)
+    return response.status_code, body
+
+
 def get_etl_attributes():
     '''
     Attempts to get ETL attributes.  Creates if not exists.
     Returns next_run, run_interval, and retention.
+    Retries every INTERVAL seconds while the backend is unavailable.
     '''
     url = BACKEND_API + "/api/etljobs?etl_name=" + ETL_NAME
-    logging.info('Pulling etl job config from api endpoint - %s', url)
-    try:
-        response = requests.get(url, timeout=10)
-    except requests.exceptions.RequestException as error:
-        logging.error(error)
-    if response.status_code == 204:
-        logging.info('API returned status of %s', response.status_code)
-        logging.info('No etl job results found')
-        (next_run, run_interval, retention) = add_etl_job()
-    elif response.status_code == 201:
-        logging.info('ETL job instructions located')
-        next_run = response.json()[0]['next_run']
-        next_run = time.strptime(next_run, "%a, %d %b %Y %H:%M:%S %Z")
-        next_run = datetime.fromtimestamp(mktime(next_run))
-        retention = response.json()[0]['retention']
-        run_interval = response.json()[0]['int_time']
-    else:
-        logging.error('Could not configure ETL attributes')
-        sys.exit(500)
-    return next_run, run_interval, retention
+    while True:
+        logging.info('Pulling etl job config from api endpoint - %s', url)
+        try:
+            status_code, body = conditional_get(url)
+        except requests.exceptions.RequestException as error:
+            logging.error(error)
+            status_code = 503
+        if status_code == 204:
+            logging.info('API returned status of %s', status_code)
+            logging.info('No etl job results found')
+            attributes = add_etl_job()
+            if attributes is not None:
+                return attributes
+        elif status_code == 201:
+            logging.info('ETL job instructions located')
+            next_run = body[0]['next_run']
+            next_run = time.strptime(next_run, "%a, %d %b %Y %H:%M:%S %Z")
+            next_run = datetime.fromtimestamp(mktime(next_run))
+            retention = body[0]['retention']
+            run_interval = body[0]['int_time']
+            return next_run, run_interval, retention
+        elif status_code != 503:
+            logging.error('Could not configure ETL attributes')
+            sys.exit(500)
+        logging.error('Backend unavailable, retrying in %s seconds', INTERVAL)
+        time.sleep(INTERVAL)
 
 
 def time_to_run(next_run):
@@ -213,18 +335,17 @@ def get_pc_creds():
     '''
     logging.info('Getting PC credentials from backend api')
     try:
-        response = requests.get(
-            'http://backend-api:5050/api/prismasettings', timeout=10)
-        if response.status_code == 201:
-            if response.text != '':
+        status_code, settings = conditional_get(
+            BACKEND_API + '/api/prismasettings')
+        if status_code == 201:
+            if settings is not None:
                 logging.info('Credentials successfully obtained')
-                settings = response.json()
                 api_url = settings["apiurl"]
                 api_key = settings["apikey"]
                 api_secret = settings["apisecret"]
             else:
                 logging.info('DB Contained no Saved Settings')
-        elif response.status_code == 204:
+        elif status_code == 204:
             logging.info('No Prisma Cloud credentials returned')
             return '', '', '', False
         else:
@@ -239,56 +360,245 @@ def get_pc_creds():
 def update_etl(start_time, elapsed, next_run):
     '''
     Update the existing ETL job row with previous elapsed time
-    and the next run time.
+    and the next run time.  Goes through the backend api so its
+    cached etl job listing is invalidated.
     '''
     logging.info('Updating ETL Job data')
-    conn = db_connect(DB_SETTINGS)
-    sql = (
-        "UPDATE reporting.etl_jobs SET next_run = \'" +
-        str(next_run) + "\', elapsed = \'" + str(elapsed) +
-        "\', last_run = \'" + str(start_time) +
-        "\' WHERE conn_name = \'" + ETL_NAME + "\'"
-    )
-    db_write(conn, sql)
-    logging.info('Closing DB Connection')
-    conn.close()
+    url = BACKEND_API + "/api/etljobs"
+    data = json.dumps({
+        'conn_name': ETL_NAME, 'next_run': next_run,
+        'elapsed': elapsed, 'last_run': start_time
+    }, indent=4, default=str)
+    try:
+        response = requests.put(url, json=data, timeout=10)
+    except requests.exceptions.RequestException as error:
+        logging.error(error)
+        return False
+    if response.status_code != 201:
+        logging.error('Could not update ETL job')
+        return False
+    return True
 
 
 def purge_data(retention):
     '''
-    Remove records older than "retention" days from DB
+    Remove records older than "retention" days from DB by
+    dropping their daily partitions.  In diff storage, drop the
+    history rows that ended before the oldest retained day.
     '''
     logging.info(
         'Purging database records older than %s days', retention)
-    conn = db_connect(DB_SETTINGS)
-    sql = ("DELETE FROM reporting.coverage * WHERE date_added::date <= date \'" +
-           ((datetime.now() - timedelta(days=retention)).strftime('%Y-%m-%d')) + "\';")
-    db_write(conn, sql)
+    conn = db_connect_retry(DB_SETTINGS)
+    oldest = datetime.now().date() - timedelta(days=retention - 1)
+    if COVERAGE_STORAGE == 'diff':
+        db_write(conn, "DELETE FROM reporting.coverage_history WHERE valid_to <= %s",
+                 (oldest,))
+    else:
+        drop_partitions_before(conn, 'coverage', oldest)
     logging.info('Closing DB Connection')
     conn.close()
 
 
+def coverage_dtypes(header):
+    '''
+    Maps the kept columns of the discovery CSV header, which follow the
+    order of COVERAGE_COLUMNS, to explicit dtypes.  Returns None when the
+    header does not have the expected shape and dtypes are inferred.
+    '''
+    kept = [column for column in header if column not in DROPPED_COLUMNS]
+    if len(kept) != len(COVERAGE_COLUMNS) - 1:
+        logging.warning('Unexpected coverage CSV columns %s', kept)
+        return None
+    return {column: COVERAGE_DTYPES[db_column]
+            for column, db_column in zip(kept, COVERAGE_COLUMNS)
+            if db_column in COVERAGE_DTYPES}
+
+
+def read_coverage_csv(source, chunk_rows=CSV_CHUNK_ROWS):
+    '''
+    Parses the discovery CSV from source, a file path read through a
+    memory map or a text file object, without ever materializing
+    DROPPED_COLUMNS.  Large files are parsed chunk_rows rows at a time
+    and the chunks combined with their categoricals unioned.
+    '''
+    if isinstance(source, str):
+        with open(source, newline='', encoding='utf-8') as spool:
+            header = next(csv.reader([spool.readline()]))
+    else:
+        header = next(csv.reader([source.readline()]))
+        source.seek(0)
+    options = {
+        'usecols': lambda column: column not in DROPPED_COLUMNS,
+        'dtype': coverage_dtypes(header),
+        'memory_map': isinstance(source, str),
+    }
+    chunks = list(pd.read_csv(source, chunksize=chunk_rows, **options))
+    if len(chunks) == 1:
+        return chunks[0]
+    if not chunks:
+        if not isinstance(source, str):
+            source.seek(0)
+        return pd.read_csv(source, **options)
+    return pd.DataFrame({
+        column: union_categoricals([chunk[column] for chunk in chunks], ignore_order=True)
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype)
+        else pd.concat([chunk[column] for chunk in chunks], ignore_index=True)
+        for column in chunks[0].columns
+    })
+
+
+def compute_headers():
+    '''
+    Auth headers for the Prisma Cloud compute api using the session
+    token held by pc_api, logging in or extending it as needed
+    '''
+    if not pc_api.token:
+        pc_api.login_compute()
+    elif int(time.time() - pc_api.token_timer) > pc_api.token_limit:
+        pc_api.extend_login_compute()
+    if pc_api.api:
+        return {'x-redlock-auth': pc_api.token}
+    return {'Authorization': "Bearer %s" % pc_api.token}
+
+
+def clear_spool(keep=None):
+    '''
+    Removes spooled downloads other than keep, its part file and the
+    validator saved for it
+    '''
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        if keep is None or path not in (keep, keep + '.part', keep + '.part.validator'):
+            os.remove(path)
+
+
+def response_validator(response):
+    '''
+    Strong ETag, else Last-Modified, of a response, usable in If-Range.
+    None if it has neither.
+    '''
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def resumable_offset(part, validator_path):
+    '''
+    Size of the part file and its saved validator.  A part file without
+    a validator cannot be resumed safely and is discarded.
+    '''
+    if not os.path.exists(part):
+        return 0, None
+    if os.path.exists(validator_path):
+        with open(validator_path, encoding='utf-8') as saved:
+            validator = saved.read().strip()
+        if validator:
+            return os.path.getsize(part), validator
+    logging.info('No validator saved for %s, restarting download', part)
+    os.remove(part)
+    return 0, None
+
+
+def content_range_start(response):
+    '''First byte of a 206 response's Content-Range, None if unparsable'''
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        return int(content_range.split(' ', 1)[1].split('-', 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def spool_discovery_download(day):
+    '''
+    Streams the cloud discovery CSV of day to a file in SPOOL_DIR and
+    returns its path, None if every attempt failed.  Bytes arrive in a
+    ".part" file which later attempts, including after a restart,
+    resume with a Range request.  The CSV is generated per request, so
+    a resume sends the ETag or Last-Modified of the response the part
+    file started from as If-Range, and the server sends a whole new
+    file if it changed.  Attempts back off exponentially.
+    '''
+    path = os.path.join(SPOOL_DIR, 'discovery-%s.csv' % day)
+    part = path + '.part'
+    validator_path = part + '.validator'
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    clear_spool(keep=path)
+    if os.path.exists(path):
+        logging.info('Reusing spooled download %s', path)
+        return path
+    url = 'https://%s/api/v1/cloud/discovery/download' % pc_api.api_compute
+    for attempt in range(DOWNLOAD_RETRIES):
+        offset, validator = resumable_offset(part, validator_path)
+        # Ranges count encoded bytes, keep the transfer uncompressed
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%s-' % offset
+            headers['If-Range'] = validator
+        try:
+            headers.update(compute_headers())
+            with requests.get(url, headers=headers, stream=True,
+                              verify=pc_api.verify, timeout=pc_api.timeout) as response:
+                if response.status_code == 416:
+                    # Nothing left past offset, the part file is complete
+                    os.replace(part, path)
+                    if os.path.exists(validator_path):
+                        os.remove(validator_path)
+                    return path
+                response.raise_for_status()
+                if offset and (response.status_code != 206 or
+                               content_range_start(response) != offset):
+                    logging.info('Download changed or range not honored, restarting')
+                    offset = 0
+                    if response.status_code == 206:
+                        # Only part of some other file, start over next attempt
+                        os.remove(part)
+                        continue
+                if not offset:
+                    validator = response_validator(response)
+                    if validator:
+                        with open(validator_path, 'w', encoding='utf-8') as saved:
+                            saved.write(validator)
+                    elif os.path.exists(validator_path):
+                        os.remove(validator_path)
+                logging.info('Downloading cloud discovery CSV from byte %s', offset)
+                with open(part, 'ab' if offset else 'wb') as spool:
+                    for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                        spool.write(block)
+            os.replace(part, path)
+            if os.path.exists(validator_path):
+                os.remove(validator_path)
+            logging.info('Spooled %s bytes to %s', os.path.getsize(path), path)
+            return path
+        except (requests.exceptions.RequestException, OSError) as error:
+            delay = DOWNLOAD_BACKOFF * 2 ** attempt
+            logging.error('Download attempt %s failed: %s, retrying in %ss',
+                          attempt + 1, error, delay)
+            time.sleep(delay)
+    return None
+
+
 def get_coverage_df():
     '''
-    Pull down coverage CSV from endpoint, drop a few
-    columns, then return as dataframe.
+    Spool coverage CSV from endpoint to disk, parse only the
+    columns kept, then return as dataframe.  None if the
+    download failed.  A spooled file that does not parse, e.g.
+    truncated or empty, is discarded so the retry downloads it again.
     '''
     logging.info('Retrieving coverage as a CSV')
     date_added = [datetime.now().strftime("%Y-%m-%d")]
-    buffer = io.StringIO(pc_api.cloud_discovery_download())
-    coverage_df = pd.read_csv(filepath_or_buffer=buffer)
-    coverage_df.drop('Project', axis=1, inplace=True)
-    coverage_df.drop('Image ID', axis=1, inplace=True)
-    coverage_df.drop('FQDN', axis=1, inplace=True)
-    coverage_df.drop('Resource Group', axis=1, inplace=True)
-    coverage_df.drop('Running Tasks', axis=1, inplace=True)
-    coverage_df.drop('Active Services', axis=1, inplace=True)
-    coverage_df.drop('ARN', axis=1, inplace=True)
-    coverage_df.drop('Last Modified', axis=1, inplace=True)
-    coverage_df.drop('Created At', axis=1, inplace=True)
-    coverage_df.drop('Additional Data', axis=1, inplace=True)
-    coverage_df.drop('Status', axis=1, inplace=True)
-    coverage_df.drop('Nodes', axis=1, inplace=True)
+    path = spool_discovery_download(date_added[0])
+    if path is None:
+        return None
+    try:
+        coverage_df = read_coverage_csv(path)
+    except ValueError as error:
+        # pandas ParserError and EmptyDataError, and mmap of an empty file
+        logging.error('Discarding unparsable download %s: %s', path, error)
+        os.remove(path)
+        return None
     coverage_df['date_added'] = date_added[0]
     return coverage_df
 
@@ -296,14 +606,13 @@ def get_coverage_df():
 def write_to_redis(rd_var, working_df):
     '''
     Receives the name of variable to store in redis cache
-    plus the actual dataframe and writes to cache.
+    plus the actual dataframe and writes to cache in CACHE_FORMAT.
     '''
     logging.info('Creating connection to redis cache')
-    redis_conn = DirectRedis(host=REDIS_CACHE, port=6379)
+    redis_conn = redis.Redis(host=REDIS_CACHE, port=6379)
     while True:
         try:
-            redis_conn.set(rd_var,
-                           working_df)
+            publish_frame(redis_conn, rd_var, working_df)
             break
         except Exception as ex:
             logging.error(
@@ -314,41 +623,196 @@ def write_to_redis(rd_var, working_df):
     return True
 
 
+def summarize_coverage(coverage_df):
+    '''
+    Aggregates the coverage snapshot into total and defended counts per
+    provider, service, region, account and runtime, with the defended
+    percentage.  Returns None when the snapshot columns are unexpected.
+    '''
+    if len(coverage_df.columns) != len(COVERAGE_COLUMNS):
+        logging.warning('Cannot summarize coverage columns %s', list(coverage_df.columns))
+        return None
+    coverage_df = coverage_df.set_axis(COVERAGE_COLUMNS, axis=1)
+    keys = {}
+    for column in ['date_added'] + SUMMARY_KEYS:
+        # Group missing values as '', which loads back as NULL
+        values = coverage_df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) and '' not in values.cat.categories:
+            values = values.cat.add_categories('')
+        keys[column] = values.fillna('')
+    summary = coverage_df[['defended']].groupby(
+        [keys[column] for column in keys], observed=True, sort=False
+    ).agg(total=('defended', 'size'), defended=('defended', 'sum')).reset_index()
+    summary['defended'] = summary['defended'].astype('int64')
+    summary['pct_defended'] = (summary['defended'] / summary['total'] * 100).round(1)
+    return summary
+
+
+def summary_to_db(summary, retention):
+    '''
+    Replaces the summary of its day in reporting.coverage_summary,
+    drops days older than "retention", and returns the trend of
+    total and defended counts per provider across retained days.
+    '''
+    conn = db_connect_retry(DB_SETTINGS)
+    oldest = datetime.now().date() - timedelta(days=retention - 1)
+    logging.info('DF dump to table - coverage_summary')
+    trend = None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM reporting.coverage_summary "
+                "WHERE date_added = ANY(%s::date[]) OR date_added < %s",
+                (list(summary['date_added'].unique()), oldest))
+            copy_frame(conn, summary[SUMMARY_COLUMNS], 'coverage_summary', SUMMARY_COLUMNS)
+            cursor.execute(
+                "SELECT date_added, provider, sum(total), sum(defended) "
+                "FROM reporting.coverage_summary "
+                "GROUP BY date_added, provider ORDER BY date_added, provider")
+            trend = pd.DataFrame(
+                cursor.fetchall(), columns=['date_added', 'provider', 'total', 'defended'])
+        conn.commit()
+        trend['pct_defended'] = (trend['defended'] / trend['total'] * 100).round(1)
+    except psycopg2.Error as error:
+        conn.rollback()
+        logging.error(error)
+    logging.info('Closing DB Connection')
+    conn.close()
+    return trend
+
+
 def df_to_db(df_to_write):
     """
-    Writes dataframe to database table
+    Streams dataframe into database table with COPY, replacing the
+    rows already loaded for its days.  The load is rolled back as a
+    whole on failure.
     """
-    conn = db_connect(DB_SETTINGS)
+    conn = db_connect_retry(DB_SETTINGS)
     table = 'coverage'
     logging.info('DF dump to table - %s', table)
-    buffer = StringIO()
-    df_to_write.to_csv(buffer, header=False, index=False)
-    buffer.seek(0)
-    cursor = conn.cursor()
-    cursor.execute("SET search_path TO reporting")
+    loaded = True
+    days = df_to_write['date_added'].unique()
+    if not ensure_partitions(conn, table, days):
+        conn.close()
+        return False
     try:
-        cursor.copy_from(buffer, table, sep=",")
+        with conn.cursor() as cursor:
+            for day in days:
+                cleared = clear_partition(cursor, table, day)
+                if cleared:
+                    logging.info('Replacing %s coverage rows already loaded for %s',
+                                 cleared, day)
+        copy_frame(conn, df_to_write, table, COVERAGE_COLUMNS,
+                   force_not_null=COVERAGE_NOT_NULL)
         conn.commit()
-    except requests.exceptions.RequestException as error:
+    except psycopg2.Error as error:
         conn.rollback()
-        cursor.close()
         logging.error(error)
-    cursor.close()
+        loaded = False
     logging.info('Closing DB Connection')
     conn.close()
-    return True
+    return loaded
+
+
+def diff_to_db(df_to_write):
+    """
+    Stores only the changes between the snapshot in dataframe and
+    the current coverage_history: rows of removed or changed resources
+    are closed with valid_to, new or changed ones opened with
+    valid_from.  Resources are identified by HISTORY_KEY_COLUMNS.
+    Identical rows are stored once with their number of copies.  Of
+    rows sharing a key but differing in other columns, one is kept,
+    picked deterministically, and the others are counted in the log.
+    reporting.coverage_asof(date) rebuilds any retained day.
+    """
+    conn = db_connect_retry(DB_SETTINGS)
+    day = df_to_write['date_added'].iloc[0] if len(df_to_write.index) else \
+        datetime.now().strftime('%Y-%m-%d')
+    logging.info('DF diff to table - coverage_history for %s', day)
+    data = pgsql.SQL(', ').join(
+        pgsql.Identifier(column) for column in COVERAGE_COLUMNS[:-1])
+    key = pgsql.SQL(', ').join(
+        pgsql.Identifier(column) for column in HISTORY_KEY_COLUMNS)
+    attributes = [column for column in COVERAGE_COLUMNS[:-1]
+                  if column not in HISTORY_KEY_COLUMNS] + ['copies']
+    loaded = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TABLE coverage_staging (" + COVERAGE_DDL + ") ON COMMIT DROP")
+            copy_frame(conn, df_to_write, 'coverage_staging', COVERAGE_COLUMNS,
+                       schema='pg_temp', force_not_null=COVERAGE_NOT_NULL)
+            cursor.execute(pgsql.SQL(
+                "CREATE TEMP TABLE coverage_snapshot ON COMMIT DROP AS "
+                "SELECT DISTINCT ON (resource_key) * FROM ("
+                "SELECT md5(row({key})::text) AS resource_key, {data}, "
+                "count(*)::int AS copies "
+                "FROM coverage_staging GROUP BY {data}) staged "
+                "ORDER BY resource_key, copies DESC, {order}; "
+                "CREATE INDEX ON coverage_snapshot (resource_key); "
+                "ANALYZE coverage_snapshot").format(
+                    key=key, data=data,
+                    order=pgsql.SQL(', ').join(
+                        pgsql.Identifier(column) for column in attributes[:-1])))
+            cursor.execute(
+                "SELECT (SELECT count(*) FROM coverage_staging), count(*), "
+                "COALESCE(sum(copies), 0) FROM coverage_snapshot")
+            staged, kept, counted = cursor.fetchone()
+            if staged > kept:
+                logging.info('Coverage history: %s identical rows stored as copies, '
+                             '%s rows sharing a resource key collapsed',
+                             counted - kept, staged - counted)
+            cursor.execute(pgsql.SQL(
+                "UPDATE reporting.coverage_history h SET valid_to = %(day)s "
+                "WHERE h.valid_to IS NULL AND NOT EXISTS ("
+                "SELECT 1 FROM coverage_snapshot s "
+                "WHERE s.resource_key = h.resource_key "
+                "AND ({snapshot}) IS NOT DISTINCT FROM ({history}))").format(
+                    snapshot=pgsql.SQL(', ').join(
+                        pgsql.Identifier('s', column) for column in attributes),
+                    history=pgsql.SQL(', ').join(
+                        pgsql.Identifier('h', column) for column in attributes)),
+                {'day': day})
+            closed = cursor.rowcount
+            cursor.execute(pgsql.SQL(
+                "INSERT INTO reporting.coverage_history "
+                "(resource_key, {data}, copies, valid_from) "
+                "SELECT resource_key, {data}, copies, %(day)s FROM coverage_snapshot s "
+                "WHERE NOT EXISTS (SELECT 1 FROM reporting.coverage_history h "
+                "WHERE h.valid_to IS NULL AND h.resource_key = s.resource_key)").format(
+                    data=data),
+                {'day': day})
+            opened = cursor.rowcount
+            # Rows opened and closed by reruns on the same day were never valid
+            cursor.execute(
+                "DELETE FROM reporting.coverage_history "
+                "WHERE valid_from = %(day)s AND valid_to = %(day)s", {'day': day})
+        conn.commit()
+        logging.info('Coverage history: %s rows closed, %s rows opened', closed, opened)
+    except psycopg2.Error as error:
+        conn.rollback()
+        logging.error(error)
+        loaded = False
+    logging.info('Closing DB Connection')
+    conn.close()
+    return loaded
 
 
 def main():
     '''
-    Start loop with 1 minute check-in interval.
-    Every checkin, look in database for next run time.
+    Start loop which sleeps until the next run time.
     If next run time has passed, execute next run.
+    Wakes early and re-reads the next run time when the ETL job
+    changes, e.g. on a run now request.
     '''
 
     # Initialize DB Tables, if required
     init_db()
 
+    # Listen for etl job changes before reading them, so none are missed
+    scheduler = Scheduler(DB_SETTINGS, ETL_NAME)
+    scheduler.listen()
+
     # Gather ETL attributes, or create if non existant
     (next_run, run_interval, retention) = get_etl_attributes()
     logging.info('Next Run will happen after %s', next_run)
@@ -356,7 +820,7 @@ def main():
     logging.info(
         '%s days records will be maintained in the database', retention)
 
-    # Begin loop which will be enetered when it is is time_to_run
+    # Begin loop which will be entered when it is time_to_run
     while True:
         if time_to_run(next_run):
             start_time = time.time()
@@ -376,26 +840,46 @@ def main():
                 purge_data(retention)
 
                 # Get coverage information, store as dataframe
-                # then write to DB
+                # then write to DB.  Skipped if the download failed.
                 curr_coverage_df = get_coverage_df()
-                df_to_db(curr_coverage_df)
-
-                # Gather relevant data and store in redis as dataframe
-                write_to_redis('curr_coverage', curr_coverage_df)
-
-                # Store time of current run in elapsed for ETL job
-                elapsed = time.strftime(
-                    "%H:%M:%S", time.gmtime(time.time() - start_time))
-                logging.info('Total time to run was %s', elapsed)
-
-                # Update next run with start_time plus run_interval
-                next_run = dt_start_time + timedelta(run_interval)
-
-                # Update ETL job with new elapsed and next_run values
-                update_etl(dt_start_time, elapsed, next_run)
-
-        logging.info('Sleeping for %s', INTERVAL)
-        time.sleep(INTERVAL)
+                if curr_coverage_df is None:
+                    logging.info('Coverage download failed, keeping the spooled part to resume')
+                elif not (diff_to_db(curr_coverage_df) if COVERAGE_STORAGE == 'diff'
+                          else df_to_db(curr_coverage_df)):
+                    logging.info('Coverage load failed, keeping the spooled download to retry')
+                else:
+                    # Gather relevant data and store in redis as dataframe
+                    write_to_redis('curr_coverage', curr_coverage_df)
+
+                    # Aggregate coverage for the summary views
+                    summary_df = summarize_coverage(curr_coverage_df)
+                    if summary_df is not None:
+                        write_to_redis('coverage_summary', summary_df)
+                        trend_df = summary_to_db(summary_df, retention)
+                        if trend_df is not None:
+                            write_to_redis('coverage_trend', trend_df)
+
+                    # Store time of current run in elapsed for ETL job
+                    elapsed = time.strftime(
+                        "%H:%M:%S", time.gmtime(time.time() - start_time))
+                    logging.info('Total time to run was %s', elapsed)
+
+                    # Update next run with start_time plus run_interval
+                    next_run = dt_start_time + timedelta(run_interval)
+
+                    # Update ETL job with new elapsed and next_run values
+                    update_etl(dt_start_time, elapsed, next_run)
+
+                    # Loaded, the spooled download is no longer needed
+                    clear_spool()
+
+        if datetime.now() > next_run:
+            # Run could not happen or failed, retry after INTERVAL
+            next_run = datetime.now() + timedelta(seconds=INTERVAL)
+
+        # Sleep until next_run, re-read ETL attributes if the job changed
+        if scheduler.wait_until(next_run) == 'changed':
+            (next_run, run_interval, retention) = get_etl_attributes()
 
 
 if __name__ == "__main__":
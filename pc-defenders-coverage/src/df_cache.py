@@ -0,0 +1,150 @@
+'''
+DataFrame storage in the redis cache.
+
+A frame is split into row groups of CACHE_CHUNK_ROWS rows.  Every row
+group is a redis hash ("<name>:<version>:<n>") holding one compressed
+Arrow IPC stream per column, with repetitive string columns
+dictionary-encoded.  A JSON manifest under "<name>:<version>" lists the
+columns and row groups, and the "<name>:current" pointer is swapped to
+it atomically once everything is written, so readers never see a half
+written frame.  Readers can fetch a subset of the row groups and/or
+columns.  The replaced version expires after OLD_VERSION_TTL seconds to
+let in-flight readers finish.
+
+No single redis value grows beyond one column of one row group, which
+keeps writes and reads of large frames from blocking redis.
+
+CACHE_FORMAT=pickle keeps the previous single pickled value under
+"<name>", which is also what load_frame falls back to.
+
+Append-only history can instead be kept as partitions, one field per
+partition (e.g. per day) of the "<name>:partitions" hash, so a writer
+only touches the partitions that changed.  "<name>:version" is bumped
+on every partition change.
+
+Each service carries only its part of this module: the coverage ETL
+publishes whole frames, the deployed ETL publishes partitions and the
+frontend reads both.  The storage format is shared, keep the copies
+in sync when changing it.
+'''
+import os
+import time
+import json
+import pickle
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+
+CACHE_FORMAT = os.environ.get('CACHE_FORMAT', 'arrow')
+CACHE_COMPRESSION = os.environ.get('CACHE_COMPRESSION', 'zstd')
+CACHE_CHUNK_ROWS = int(os.environ.get('CACHE_CHUNK_ROWS', '50000'))
+OLD_VERSION_TTL = 300
+DICTIONARY_RATIO = 0.5
+
+
+def pointer_key(name):
+    '''Key holding the versioned key currently published for name'''
+    return name + ':current'
+
+
+def dictionary_worthy(column):
+    '''True for string columns with mostly repeated values'''
+    if not pa.types.is_string(column.type) or len(column) == 0:
+        return False
+    return pc.count_distinct(column).as_py() <= len(column) * DICTIONARY_RATIO
+
+
+def encode_table(table, compression=CACHE_COMPRESSION):
+    '''Serializes an Arrow table as a compressed IPC stream'''
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_frame(df, compression=CACHE_COMPRESSION):
+    '''
+    Serializes df as a single compressed Arrow IPC stream, with
+    repetitive string columns dictionary-encoded
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    columns = [
+        column.dictionary_encode() if dictionary_worthy(column) else column
+        for column in table.columns
+    ]
+    return encode_table(pa.Table.from_arrays(columns, names=table.column_names),
+                        compression)
+
+
+def decode_frame(payload):
+    '''
+    Inverse of encode_frame.  Dictionary-encoded columns come back as
+    pandas categoricals.
+    '''
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+def encode_chunks(df, chunk_rows=CACHE_CHUNK_ROWS):
+    '''
+    Yields row groups of df as row count and {column name: IPC stream}.
+    Dictionary encoding is decided once for the whole frame so every
+    row group of a column has the same type.  An empty frame still
+    yields one row group carrying the schema.
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dictionary = [dictionary_worthy(column) for column in table.columns]
+    for offset in range(0, max(table.num_rows, 1), chunk_rows):
+        chunk = table.slice(offset, chunk_rows)
+        fields = {}
+        for index, name in enumerate(chunk.column_names):
+            column = chunk.column(index)
+            if dictionary[index]:
+                column = column.dictionary_encode()
+            fields[name] = encode_table(pa.Table.from_arrays([column], names=[name]))
+        yield chunk.num_rows, fields
+
+
+def expire_version(redis_conn, data_key):
+    '''Lets a replaced manifest and its row groups expire'''
+    payload = redis_conn.get(data_key)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.expire(data_key, OLD_VERSION_TTL)
+    if payload and payload.startswith(b'{'):
+        for chunk in json.loads(payload)["chunks"]:
+            pipe.expire(chunk["key"], OLD_VERSION_TTL)
+    pipe.execute()
+
+
+def publish_frame(redis_conn, name, df, fmt=CACHE_FORMAT):
+    '''
+    Stores df under name in the configured format.
+    Returns the new version, None for the pickle format.
+    '''
+    if fmt == 'pickle':
+        pipe = redis_conn.pipeline()
+        pipe.set(name, pickle.dumps(df))
+        pipe.delete(pointer_key(name))
+        pipe.execute()
+        return None
+    version = str(time.time_ns())
+    data_key = '%s:%s' % (name, version)
+    chunks = []
+    for index, (rows, fields) in enumerate(encode_chunks(df)):
+        chunk_key = '%s:%s' % (data_key, index)
+        redis_conn.hmset(chunk_key, fields)
+        chunks.append({"key": chunk_key, "rows": rows})
+    manifest = {
+        "version": version,
+        "rows": len(df.index),
+        "columns": [str(column) for column in df.columns],
+        "chunks": chunks,
+    }
+    redis_conn.set(data_key, json.dumps(manifest))
+    old_key = redis_conn.getset(pointer_key(name), data_key)
+    if old_key:
+        expire_version(redis_conn, old_key)
+    redis_conn.delete(name)
+    logging.info('Published %s version %s in %s row groups',
+                 name, version, len(chunks))
+    return version
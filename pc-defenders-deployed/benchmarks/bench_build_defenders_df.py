@@ -0,0 +1,79 @@
+'''
+Micro-benchmark for building the defenders dataframe.
+
+Compares the previous row-at-a-time df.loc append with
+build_defenders_df at 1k/10k/100k synthetic defenders.
+
+    pip install -r requirements.txt
+    python benchmarks/bench_build_defenders_df.py
+'''
+import os
+import sys
+import time
+import random
+import logging
+import pandas as pd
+
+os.environ.setdefault('POSTGRES_USER', 'bench')
+os.environ.setdefault('POSTGRES_PASSWORD', 'bench')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from app import build_defenders_df  # noqa: E402
+
+SIZES = [1000, 10000, 100000]
+LEGACY_MAX = 10000
+
+
+def make_defenders(count):
+    '''Synthetic defenders_list_read output, a tenth without accountID'''
+    rng = random.Random(count)
+    defenders = []
+    for i in range(count):
+        metadata = {'provider': 'aws', 'region': 'us-east-1'}
+        if rng.random() > 0.1:
+            metadata['accountID'] = str(rng.randrange(10 ** 11, 10 ** 12))
+        defenders.append({
+            'hostname': 'host-%s' % i,
+            'version': rng.choice(['22.12.582', '22.06.197', '22.01.839']),
+            'type': rng.choice(['daemonset', 'docker', 'serverless']),
+            'category': rng.choice(['container', 'host', 'serverless']),
+            'connected': True,
+            'cloudMetadata': metadata,
+        })
+    return defenders
+
+
+def legacy_build(defenders_api_lod, date_added):
+    '''The loop previously inlined in main()'''
+    df_defenders = pd.DataFrame(
+        columns=['hostname', 'version', 'type', 'category', 'connected', 'accountID', 'date_added'])
+    for defender in defenders_api_lod:
+        if 'accountID' not in defender['cloudMetadata']:
+            defender['cloudMetadata']['accountID'] = 'aws'
+        df_defenders.loc[len(df_defenders.index)] = [
+            defender['hostname'], defender['version'], defender['type'], defender['category'],
+            defender['connected'], defender['cloudMetadata']['accountID'], date_added
+        ]
+    return df_defenders
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    logging.disable(logging.INFO)
+    print('%10s %12s %14s' % ('defenders', 'legacy (s)', 'vectorized (s)'))
+    for size in SIZES:
+        defenders = make_defenders(size)
+        vectorized = timed(build_defenders_df, defenders, '2023-01-01')
+        if size <= LEGACY_MAX:
+            legacy = '%12.3f' % timed(legacy_build, defenders, '2023-01-01')
+        else:
+            legacy = '%12s' % 'skipped'
+        print('%10s %s %14.3f' % (size, legacy, vectorized))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,32 +10,54 @@ from datetime import datetime, timedelta
 from time import mktime
 import time
 import json
-from io import StringIO
 import os
 import logging
 import requests
 import pandas as pd
 import psycopg2
-from direct_redis import DirectRedis
+import redis
 from prismacloud.api import pc_api
+from scheduler import Scheduler, NOTIFY_SQL
+from copy_loader import copy_frame
+from partitions import (ensure_partitioned, ensure_partitions, clear_partition,
+                        drop_partitions_before)
+from df_cache import (partition_names, publish_partition, remove_partition,
+                      expire_partitions, drop_frame, drop_partitions)
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
 ETL_NAME = 'defenders_deployed'
+DEFENDERS_COLUMNS = [
+    'hostname', 'version', 'type', 'category', 'connected', 'accountid',
+    'date_added'
+]
+DEFENDERS_DDL = '''
+    hostname varchar (128) NOT NULL,
+    version varchar (9) NOT NULL,
+    type varchar (24) NOT NULL,
+    category varchar (24) NOT NULL,
+    connected varchar (24) NOT NULL,
+    accountID varchar (64) NOT NULL,
+    date_added DATE NOT NULL
+'''
 db_settings = {
     "host":     "postgres-edw",
     "database": "prisma",
     "user":     os.environ['POSTGRES_USER'],
     "password": os.environ['POSTGRES_PASSWORD'],
 }
+HTTP_CACHE = {}
+INGEST_MODE = os.environ.get('INGEST_MODE', 'stream')
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '5000'))
+DEFENDERS_PAGE_SIZE = 50
 
 
-def db_write(conn, sql):
+def db_write(conn, sql, params=None):
     """Uses received db connection and executes received sql"""
     logging.info('DB Write - %s', sql)
     cursor = conn.cursor()
     try:
-        cursor.execute(sql)
-    except requests.exceptions.RequestException as error:
+        cursor.execute(sql, params)
+    except psycopg2.Error as error:
         conn.rollback()
         cursor.close()
         logging.error(error)
@@ -45,34 +67,47 @@ def db_write(conn, sql):
     return True
 
 
-def df_to_db(conn, df_to_write, table):
-    """Writes dataframe to database table"""
+def replace_day(conn, day):
+    """
+    Clears the defenders partition of day in the open transaction,
+    so a rerun replaces the day instead of duplicating it
+    """
+    with conn.cursor() as cursor:
+        cleared = clear_partition(cursor, 'defenders', day)
+    if cleared:
+        logging.info('Replacing %s defenders already loaded for %s', cleared, day)
+
+
+def df_to_db(conn, df_to_write, table, commit=True, day=None):
+    """
+    Streams dataframe into database table with COPY
+    With commit=False the rows stay in the open transaction
+    With day, the rows already loaded for day are replaced
+    """
     logging.info('DF dump to table - %s', table)
-    buffer = StringIO()
-    df_to_write.to_csv(buffer, header=False, index=False)
-    buffer.seek(0)
-    cursor = conn.cursor()
-    cursor.execute("SET search_path TO reporting")
     try:
-        cursor.copy_from(buffer, table, sep=",")
-        conn.commit()
-    except requests.exceptions.RequestException as error:
+        if day is not None:
+            replace_day(conn, day)
+        copy_frame(conn, df_to_write, table, DEFENDERS_COLUMNS,
+                   force_not_null=DEFENDERS_COLUMNS[:-1])
+        if commit:
+            conn.commit()
+    except psycopg2.Error as error:
         conn.rollback()
-        cursor.close()
         logging.error(error)
         return False
-    cursor.close()
     return True
 
 
-def db_read(conn, sql):
+def db_read(conn, sql, params=None):
     """Uses received db connection and executes received sql"""
     logging.info('DB Read - %s', sql)
     q_list = []
     cursor = conn.cursor()
     try:
-        cursor.execute(sql)
-    except requests.exceptions.RequestException as error:
+        cursor.execute(sql, params)
+    except psycopg2.Error as error:
+        conn.rollback()
         cursor.close()
         logging.error(error)
         return False
@@ -93,21 +128,57 @@ def db_connect(params_dict):
     return l_conn
 
 
+class DbSession:
+    '''
+    Long-lived Postgres connection for the worker loop.
+    connection() health checks the held connection and reconnects,
+    retrying every 5 seconds, when it was closed or the server dropped it.
+    '''
+
+    def __init__(self, params_dict):
+        self.params_dict = params_dict
+        self.conn = None
+
+    def _alive(self):
+        if self.conn is None or self.conn.closed:
+            return False
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            self.conn.rollback()
+        except psycopg2.Error as error:
+            logging.error(error)
+            return False
+        return True
+
+    def connection(self):
+        """Returns a healthy connection"""
+        if self._alive():
+            return self.conn
+        self.close()
+        conn = db_connect(self.params_dict)
+        while conn == 1:
+            time.sleep(5)
+            conn = db_connect(self.params_dict)
+        self.conn = conn
+        return conn
+
+    def close(self):
+        """Closes the held connection, if any"""
+        if self.conn is not None and not self.conn.closed:
+            logging.info('Closing DB Connection')
+            self.conn.close()
+        self.conn = None
+
+
 def init_defenders_table(conn):
     '''
     Initializing required tables for etl job
     '''
-    logging.info('Initializing DB tables - defenders, etl_jobs')
+    logging.info(
+        'Initializing DB tables - defenders, defenders_daily_rollup, etl_jobs')
+    partitioned = ensure_partitioned(conn, 'defenders', DEFENDERS_DDL, DEFENDERS_COLUMNS)
     sql = '''
-    CREATE TABLE IF NOT EXISTS reporting.defenders (
-        hostname varchar (128) NOT NULL,
-        version varchar (9) NOT NULL,
-        type varchar (24) NOT NULL,
-        category varchar (24) NOT NULL,
-        connected varchar (24) NOT NULL,
-        accountID varchar (64) NOT NULL,
-        date_added DATE NOT NULL
-    );
         CREATE TABLE IF NOT EXISTS reporting.etl_jobs (
         conn_name varchar (128) NOT NULL,
         conn_since TIMESTAMP NOT null,
@@ -117,30 +188,135 @@ def init_defenders_table(conn):
         retention INT NOT null,
         int_time INT
     );
+    CREATE TABLE IF NOT EXISTS reporting.defenders_daily_rollup (
+        date_added DATE NOT NULL,
+        category varchar (24) NOT NULL,
+        version varchar (9) NOT NULL,
+        connected varchar (24) NOT NULL,
+        accountID varchar (64) NOT NULL,
+        total INT NOT NULL,
+        PRIMARY KEY (date_added, category, version, connected, accountID)
+    );
+    INSERT INTO reporting.defenders_daily_rollup
+        SELECT date_added, category, version, connected, accountID, count(*)
+        FROM reporting.defenders
+        WHERE NOT EXISTS (SELECT 1 FROM reporting.defenders_daily_rollup)
+        GROUP BY date_added, category, version, connected, accountID;
     GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA reporting TO prisma;
     '''
-    if db_write(conn, sql):
+    if partitioned and db_write(conn, sql) and db_write(conn, NOTIFY_SQL):
         logging.info('...success')
     else:
         logging.info('...failed')
 
 
+def conditional_get(url):
+    '''
+    GET url sending If-None-Match with the last ETag seen for it.
+    A 304 replays the status and parsed body stored with that ETag,
+    so unchanged responses are neither downloaded nor re-parsed.
+    Returns status code and parsed json (None for an empty body).
+    '''
+    headers = {}
+    cached = HTTP_CACHE.get(url)
+    if cached:
+        headers['If-None-Match'] = cached[0]
+    response = requests.get(url, headers=headers, timeout=10)
+    if response.status_code == 304 and cached:
+        logging.info('%s not modified, reusing last response', url)
+        return cached[1], cached[2]
+    body = response.json() if response.text != '' else None
+    etag = response.headers.get('ETag')
+    if etag:
+        HTTP_CACHE[url] = (etag, response.status_code, body)
+    else:
+        HTTP_CACHE.pop(url, None)
+    return response.status_code, body
+
+
+def rollup_day(conn, day):
+    '''
+    Recompute the defenders_daily_rollup counts for a single day from
+    that day's defenders rows.  The day is replaced in one transaction.
+    '''
+    logging.info('Rolling up defenders for %s', day)
+    sql = '''
+    DELETE FROM reporting.defenders_daily_rollup WHERE date_added = %(day)s;
+    INSERT INTO reporting.defenders_daily_rollup
+        SELECT date_added, category, version, connected, accountID, count(*)
+        FROM reporting.defenders
+        WHERE date_added = %(day)s
+        GROUP BY date_added, category, version, connected, accountID;
+    '''
+    return db_write(conn, sql, {'day': day})
+
+
+def read_rollup(conn, days=None):
+    '''
+    Returns the daily rollup as df_defenders, limited to days when given
+    '''
+    sql = (
+        "SELECT date_added, category, version, connected, accountID, total "
+        "FROM reporting.defenders_daily_rollup")
+    params = None
+    if days is not None:
+        sql += " WHERE date_added = ANY(%s::date[])"
+        params = (list(days),)
+    return pd.DataFrame(
+        db_read(conn, sql, params),
+        columns=['date_added', 'category', 'version', 'connected', 'accountID', 'total'])
+
+
+def publish_rollup(redis_conn, conn, day, cutoff):
+    '''
+    Delta publish of the rollup into per-day redis partitions of
+    df_defenders.  Only day is rewritten, plus any retained day missing
+    from the cache (first run, or a cache flush).  A day without rollup
+    rows is not published.  Partitions before cutoff are dropped.
+    '''
+    stored = set(partition_names(redis_conn, 'df_defenders'))
+    retained = {str(row[0]) for row in db_read(
+        conn,
+        "SELECT DISTINCT date_added FROM reporting.defenders_daily_rollup "
+        "WHERE date_added >= %s", (cutoff,))}
+    days = sorted((retained - stored) | {day})
+    logging.info('Publishing rollup partitions for %s', ', '.join(days))
+    df_rollup = read_rollup(conn, days)
+    for part in days:
+        df_day = df_rollup[df_rollup['date_added'].astype(str) == part].reset_index(drop=True)
+        if df_day.empty:
+            remove_partition(redis_conn, 'df_defenders', part)
+            continue
+        publish_partition(redis_conn, 'df_defenders', part, df_day)
+    expire_partitions(redis_conn, 'df_defenders', cutoff)
+    # Drop the full frames published before partitioning, and the one
+    # row per defender expansion the frontend no longer reads
+    drop_frame(redis_conn, 'df_defenders')
+    drop_frame(redis_conn, 'df_all_defenders')
+    drop_partitions(redis_conn, 'df_all_defenders')
+
+
 def get_run_stats():
     '''
     Pull DB run-time stats
+    Returns the etl job, None when it is not registered (204) and
+    False when the backend could not tell, e.g. a 503 or no connection
     '''
     url = "http://backend-api:5050/api/etljobs?etl_name=" + ETL_NAME
     logging.info('Pulling etl job config from api endpoint - %s', url)
     try:
-        response = requests.get(url, timeout=10)
+        status_code, body = conditional_get(url)
     except requests.exceptions.RequestException as error:
         logging.error(error)
-    if response.status_code != 201:
-        logging.info('API returned status of %s', response.status_code)
+        return False
+    if status_code == 204:
         logging.info('No etl job results found')
+        return None
+    if status_code != 201:
+        logging.error('API returned status of %s', status_code)
         return False
     logging.info('ETL job instructions located')
-    return (response.json())[0]
+    return body[0]
 
 
 def add_etl_job(conn_since, next_run, last_run, elapsed, retention, int_time):
@@ -157,6 +333,7 @@ def add_etl_job(conn_since, next_run, last_run, elapsed, retention, int_time):
         response = requests.post(url, json=data, timeout=10)
     except requests.exceptions.RequestException as error:
         logging.error(error)
+        return False
     if response.status_code != 201:
         logging.error('Error registering etl job with DB')
         return False
@@ -164,25 +341,43 @@ def add_etl_job(conn_since, next_run, last_run, elapsed, retention, int_time):
     return True
 
 
+def update_etl_job(next_run, elapsed):
+    '''
+    Update next_run and elapsed through the backend api so its
+    cached etl job listing is invalidated
+    '''
+    url = "http://backend-api:5050/api/etljobs"
+    data = json.dumps({'conn_name': ETL_NAME, 'next_run': next_run,
+                       'elapsed': elapsed}, indent=4, default=str)
+    try:
+        response = requests.put(url, json=data, timeout=10)
+    except requests.exceptions.RequestException as error:
+        logging.error(error)
+        return False
+    if response.status_code != 201:
+        logging.error('Error updating etl job in DB')
+        return False
+    return True
+
+
 def get_pc_creds():
     '''
     Get PC credentials from backend api andpoint
     '''
     logging.info('Getting PC creentials from backend api')
     try:
-        response = requests.get(
-            'http://backend-api:5050/api/prismasettings', timeout=10)
-        if response.status_code == 201:
+        status_code, settings = conditional_get(
+            'http://backend-api:5050/api/prismasettings')
+        if status_code == 201:
             msg = ''
-            if response.text != '':
+            if settings is not None:
                 logging.info('Credentials successfully obtained')
-                settings = response.json()
                 api_url = settings["apiurl"]
                 api_key = settings["apikey"]
                 api_secret = settings["apisecret"]
             else:
                 logging.info('DB Contained no Saved Settings')
-        elif response.status_code == 204:
+        elif status_code == 204:
             msg = 'No Prisma Cloud credentials returned'
             logging.info(msg)
             return '', '', '', msg
@@ -219,24 +414,119 @@ def validate_pc_creds(api_url, api_key, api_secret):
         return False
 
 
+def build_defenders_df(defenders_api_lod, date_added):
+    '''
+    Builds the defenders dataframe from the api list-of-dictionaries
+    in a single pass.  Defenders without a cloudMetadata accountID are
+    attributed to 'aws'.
+    '''
+    df_defenders = pd.DataFrame.from_records(
+        [(defender['hostname'], defender['version'], defender['type'],
+          defender['category'], defender['connected'],
+          defender.get('cloudMetadata', {}).get('accountID'))
+         for defender in defenders_api_lod],
+        columns=['hostname', 'version', 'type', 'category', 'connected', 'accountID'])
+    df_defenders['accountID'] = df_defenders['accountID'].fillna('aws')
+    df_defenders['date_added'] = date_added
+    return df_defenders
+
+
+def compute_get(endpoint, params):
+    '''
+    Single GET against the Prisma Cloud compute api using the session
+    token held by pc_api.  Returns the requests response.
+    '''
+    if not pc_api.token:
+        pc_api.login_compute()
+    elif int(time.time() - pc_api.token_timer) > pc_api.token_limit:
+        pc_api.extend_login_compute()
+    headers = {'Content-Type': 'application/json'}
+    if pc_api.api:
+        headers['x-redlock-auth'] = pc_api.token
+    else:
+        headers['Authorization'] = "Bearer %s" % pc_api.token
+    response = requests.get('https://%s/%s' % (pc_api.api_compute, endpoint),
+                            headers=headers, params=params,
+                            verify=pc_api.verify, timeout=pc_api.timeout)
+    response.raise_for_status()
+    return response
+
+
+def iter_defender_pages(page_size=DEFENDERS_PAGE_SIZE):
+    '''
+    Yields connected defenders one api page at a time, unlike
+    defenders_list_read which returns the whole fleet as one list
+    '''
+    offset = 0
+    while True:
+        response = compute_get('api/v1/defenders', {
+            'connected': 'true', 'limit': page_size, 'offset': offset})
+        page = response.json() or []
+        if page:
+            yield page
+        offset += page_size
+        if len(page) < page_size:
+            return
+        if 'Total-Count' in response.headers and offset >= int(response.headers['Total-Count']):
+            return
+
+
+def stream_defenders_to_db(conn, date_added):
+    '''
+    Copies defenders into the defenders table page by page, writing a
+    batch every INGEST_BATCH_SIZE defenders.  Peak memory is bounded by
+    the batch size, the whole load, which replaces any defenders already
+    loaded for date_added, is committed once at the end.
+    Returns the number of defenders written, False on failure.
+    '''
+    written = 0
+    batch = []
+    try:
+        replace_day(conn, date_added)
+        for page in iter_defender_pages():
+            batch.extend(page)
+            if len(batch) >= INGEST_BATCH_SIZE:
+                if not df_to_db(conn, build_defenders_df(batch, date_added),
+                                "defenders", commit=False):
+                    raise psycopg2.DatabaseError('Batch copy failed')
+                written += len(batch)
+                batch = []
+        if batch:
+            if not df_to_db(conn, build_defenders_df(batch, date_added),
+                            "defenders", commit=False):
+                raise psycopg2.DatabaseError('Batch copy failed')
+            written += len(batch)
+    except (requests.exceptions.RequestException, psycopg2.Error) as error:
+        logging.error(error)
+        conn.rollback()
+        return False
+    conn.commit()
+    logging.info('Streamed %s defenders into table', written)
+    return written
+
+
 def main():
     '''
-    Start loop with 1 minute check-in interval.
-    Every checkin, look in database for next run time.
-    If next run time has passed, execute next run.
+    Initialize DB tables once, then loop.  Every pass, look in
+    database for next run time.  If next run time has passed, execute
+    next run over the worker's persistent DB connection.  Otherwise
+    sleep until next run, or until the etl job is changed.
 
     Need to break this apart in the future to make more
     supportable.
     '''
     msg = ''
     interval = 60
+    db_session = DbSession(db_settings)
+    init_defenders_table(db_session.connection())
+    scheduler = Scheduler(db_settings, ETL_NAME)
+    scheduler.listen()
     while True:
-        conn = db_connect(db_settings)
-        while conn == 1:
-            time.sleep(5)
-            conn = db_connect(db_settings)
-        init_defenders_table(conn)
         etl_db_obj = get_run_stats()
+        if etl_db_obj is False:
+            # Backend unavailable, ask again after interval
+            scheduler.wait_until(datetime.now() + timedelta(seconds=interval))
+            continue
         if etl_db_obj:
             next_run = etl_db_obj['next_run']
             next_run = time.strptime(next_run, "%a, %d %b %Y %H:%M:%S %Z")
@@ -249,10 +539,13 @@ def main():
             last_run = conn_since
             retention = 30
             int_time = 1
-            add_etl_job(conn_since, next_run, last_run,
-                        '00:00:00', retention, int_time)
+            if not add_etl_job(conn_since, next_run, last_run,
+                               '00:00:00', retention, int_time):
+                scheduler.wait_until(datetime.now() + timedelta(seconds=interval))
+                continue
         if datetime.now() > next_run:
             logging.info('Refresh etl data initiated')
+            conn = db_session.connection()
             start_time = time.time()
             date_added = [datetime.now().strftime("%Y-%m-%d")]
             (api_url, api_key, api_secret, msg) = get_pc_creds()
@@ -271,82 +564,69 @@ def main():
                         'Configuring prismacloud.api library settings')
                     pc_api.configure(pc_settings)
 
-                    # Build dataframe from defenders api endpoint
-                    logging.info(
-                        'Pulling list of defenders from Prisma Cloud API')
-                    defenders_api_lod = pc_api.defenders_list_read(
-                        'connected=true')
-                    logging.info(
-                        'Building datafrom from defender list-of-dictionaries')
-                    df_defenders = pd.DataFrame(
-                        columns=['hostname', 'version', 'type', 'category', 'connected', 'accountID', 'date_added'])
-                    for defender in defenders_api_lod:
-                        if 'accountID' not in defender['cloudMetadata']:
-                            defender['cloudMetadata']['accountID'] = 'aws'
-                        df_defenders.loc[len(df_defenders.index)] = [
-                            defender['hostname'], defender['version'], defender['type'], defender['category'],
-                            defender['connected'], defender['cloudMetadata']['accountID'], date_added
-                        ]
-
                     # Purge old records from DB
                     logging.info(
                         'Purging database records older than %s days', retention)
-                    sql = ("DELETE FROM reporting.defenders * WHERE date_added::date < date \'" +
-                           ((datetime.now() - timedelta(days=retention)).strftime('%Y-%m-%d')) + "\';")
-                    db_write(conn, sql)
+                    cutoff = (datetime.now() - timedelta(days=retention)
+                              ).strftime('%Y-%m-%d')
+                    drop_partitions_before(conn, 'defenders', cutoff)
+                    db_write(conn, "DELETE FROM reporting.defenders_daily_rollup WHERE date_added < %s",
+                             (cutoff,))
 
-                    # Write df to defenders table
-                    logging.info('Writing defender dataframe to table')
-                    df_to_db(conn, df_defenders, "defenders")
-
-                    # Pull all historical defender stats, store as dataframe
-                    logging.info(
-                        'Pulling rollup data from DB for push into cache')
-                    sql = (
-                        "SELECT category, date_added, version, connected, accountID FROM reporting.defenders")
-                    data_list = db_read(conn, sql)
-                    logging.info('Converting rollup data list into dataframe')
-                    df_all_defenders = pd.DataFrame(
-                        data_list, columns=['category', 'date_added', 'version', 'connected', 'accountID'])
-                    df_defenders = pd.DataFrame(
-                        data_list, columns=['category', 'date_added', 'version', 'connected', 'accountID']).groupby(
-                            ['date_added', 'category', 'version', 'connected', 'accountID'])['category'].count().reset_index(name='total')
-
-                    # Push defender dataframe to redis
-                    logging.info('Creating connection to redis cache')
-                    redis_conn = DirectRedis(host='redis-cache', port=6379)
-                    logging.info('Pushing rollup dataframe into cache')
-                    while True:
-                        try:
-                            redis_conn.set('df_all_defenders',
-                                           df_all_defenders)
-                            redis_conn.set('df_defenders', df_defenders)
-                            break
-                        except Exception as ex:
-                            logging.error(
-                                ex.args[0])
-                            time.sleep(5)
-                    logging.info(
-                        'Successfully stored dataframe in redis cache')
-                    # Update etl_jobs with new next_run
-                    next_run = datetime.now() + timedelta(int_time)
-                    elapsed = time.strftime(
-                        "%H:%M:%S", time.gmtime(time.time() - start_time))
-                    sql = (
-                        "UPDATE reporting.etl_jobs SET next_run = \'" +
-                        str(next_run) + "\', elapsed = \'" + str(elapsed) +
-                        "\' WHERE conn_name = \'" + ETL_NAME + "\'"
-                    )
-                    logging.info(
-                        'Updating etl job statistics with new next_run and elapsed')
-                    db_write(conn, sql)
+                    # Load defenders into today's partition, then roll up only that day
+                    ensure_partitions(conn, 'defenders', date_added)
+                    if INGEST_MODE == 'stream':
+                        logging.info(
+                            'Streaming defenders from Prisma Cloud API in batches of %s',
+                            INGEST_BATCH_SIZE)
+                        loaded = stream_defenders_to_db(conn, date_added[0]) is not False
+                    else:
+                        logging.info(
+                            'Pulling list of defenders from Prisma Cloud API')
+                        defenders_api_lod = pc_api.defenders_list_read(
+                            'connected=true')
+                        logging.info(
+                            'Building datafrom from defender list-of-dictionaries')
+                        df_defenders = build_defenders_df(
+                            defenders_api_lod, date_added[0])
+                        del defenders_api_lod
+                        logging.info('Writing defender dataframe to table')
+                        loaded = df_to_db(conn, df_defenders, "defenders",
+                                          day=date_added[0])
+                    if not loaded or not rollup_day(conn, date_added[0]):
+                        # Keep the day's previous rollup and cache, retry soon
+                        logging.error('Loading defenders failed, retrying in %s seconds',
+                                      interval)
+                        next_run = datetime.now()
+                    else:
+                        # Push the changed days of the rollup to redis
+                        logging.info('Creating connection to redis cache')
+                        redis_conn = redis.Redis(host='redis-cache', port=6379)
+                        logging.info('Pushing rollup partitions into cache')
+                        while True:
+                            try:
+                                publish_rollup(redis_conn, conn, date_added[0], cutoff)
+                                break
+                            except Exception as ex:
+                                logging.error(
+                                    ex.args[0])
+                                time.sleep(5)
+                        logging.info(
+                            'Successfully stored dataframe in redis cache')
+                        # Update etl_jobs with new next_run
+                        next_run = datetime.now() + timedelta(int_time)
+                        elapsed = time.strftime(
+                            "%H:%M:%S", time.gmtime(time.time() - start_time))
+                        logging.info(
+                            'Updating etl job statistics with new next_run and elapsed')
+                        update_etl_job(next_run, elapsed)
             else:
                 logging.info(
                     'Sleeping until credentials are available and valid')
-        else:
-            logging.info(
-                'Not time to refresh data yet.  Sleeping for %s seconds', interval)
-        time.sleep(interval)
+        if datetime.now() >= next_run:
+            # Run could not happen or failed, retry after interval
+            next_run = datetime.now() + timedelta(seconds=interval)
+        scheduler.wait_until(next_run)
 
 
 if __name__ == "__main__":
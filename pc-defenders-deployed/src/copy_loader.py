@@ -0,0 +1,81 @@
+'''
+Streaming loads of dataframes into Postgres with COPY.
+
+Rows are rendered as CSV one batch at a time and fed to
+COPY ... FROM STDIN WITH (FORMAT csv) through a file-like reader, so
+only a batch of serialized rows is held in memory at once.  CSV quoting
+keeps values containing commas, quotes or newlines intact.
+
+Missing values are written as unquoted empty fields, which CSV format
+loads as NULL.  Columns listed in force_not_null load them as '' instead,
+as the text format COPY used before did, so NOT NULL text columns accept
+blank values.
+'''
+import io
+import time
+import logging
+from psycopg2 import sql as pgsql
+
+COPY_BATCH_ROWS = 10000
+
+
+class IteratorReader(io.RawIOBase):
+    '''Read-only binary file over an iterator of str or bytes chunks'''
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = chunk.encode() if isinstance(chunk, str) else chunk
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def csv_batches(df, batch_rows=COPY_BATCH_ROWS):
+    '''Yields df as headerless CSV text, batch_rows rows at a time'''
+    for offset in range(0, len(df.index), batch_rows):
+        yield df.iloc[offset:offset + batch_rows].to_csv(header=False, index=False)
+
+
+def copy_statement(table, columns, schema='reporting', force_not_null=()):
+    '''
+    COPY schema.table (columns) FROM STDIN in CSV format, loading empty
+    fields of the force_not_null columns as ''
+    '''
+    options = pgsql.SQL("FORMAT csv")
+    if force_not_null:
+        options += pgsql.SQL(", FORCE_NOT_NULL ({})").format(
+            pgsql.SQL(', ').join(pgsql.Identifier(column) for column in force_not_null))
+    return pgsql.SQL("COPY {}.{} ({}) FROM STDIN WITH ({})").format(
+        pgsql.Identifier(schema), pgsql.Identifier(table),
+        pgsql.SQL(', ').join(pgsql.Identifier(column) for column in columns), options)
+
+
+def copy_frame(conn, df, table, columns, batch_rows=COPY_BATCH_ROWS,
+               schema='reporting', force_not_null=()):
+    '''
+    Streams the columns of df, in order, into schema.table within the
+    current transaction.  Missing values of the force_not_null columns
+    load as ''.  Raises psycopg2.Error on failure, the caller commits or
+    rolls back.  Returns the number of rows copied.
+    '''
+    start = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(copy_statement(table, columns, schema, force_not_null),
+                           io.BufferedReader(IteratorReader(csv_batches(df, batch_rows))))
+    elapsed = time.perf_counter() - start
+    rows = len(df.index)
+    logging.info('Copied %s rows into %s in %.2fs (%.0f rows/s)',
+                 rows, table, elapsed, rows / elapsed if elapsed else 0)
+    return rows
@@ -0,0 +1,146 @@
+'''
+DataFrame storage in the redis cache.
+
+A frame is split into row groups of CACHE_CHUNK_ROWS rows.  Every row
+group is a redis hash ("<name>:<version>:<n>") holding one compressed
+Arrow IPC stream per column, with repetitive string columns
+dictionary-encoded.  A JSON manifest under "<name>:<version>" lists the
+columns and row groups, and the "<name>:current" pointer is swapped to
+it atomically once everything is written, so readers never see a half
+written frame.  Readers can fetch a subset of the row groups and/or
+columns.  The replaced version expires after OLD_VERSION_TTL seconds to
+let in-flight readers finish.
+
+No single redis value grows beyond one column of one row group, which
+keeps writes and reads of large frames from blocking redis.
+
+CACHE_FORMAT=pickle keeps the previous single pickled value under
+"<name>", which is also what load_frame falls back to.
+
+Append-only history can instead be kept as partitions, one field per
+partition (e.g. per day) of the "<name>:partitions" hash, so a writer
+only touches the partitions that changed.  "<name>:version" is bumped
+on every partition change.
+
+Each service carries only its part of this module: the coverage ETL
+publishes whole frames, the deployed ETL publishes partitions and the
+frontend reads both.  The storage format is shared, keep the copies
+in sync when changing it.
+'''
+import os
+import json
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+
+CACHE_COMPRESSION = os.environ.get('CACHE_COMPRESSION', 'zstd')
+OLD_VERSION_TTL = 300
+DICTIONARY_RATIO = 0.5
+
+
+def pointer_key(name):
+    '''Key holding the versioned key currently published for name'''
+    return name + ':current'
+
+
+def dictionary_worthy(column):
+    '''True for string columns with mostly repeated values'''
+    if not pa.types.is_string(column.type) or len(column) == 0:
+        return False
+    return pc.count_distinct(column).as_py() <= len(column) * DICTIONARY_RATIO
+
+
+def encode_table(table, compression=CACHE_COMPRESSION):
+    '''Serializes an Arrow table as a compressed IPC stream'''
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_frame(df, compression=CACHE_COMPRESSION):
+    '''
+    Serializes df as a single compressed Arrow IPC stream, with
+    repetitive string columns dictionary-encoded
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    columns = [
+        column.dictionary_encode() if dictionary_worthy(column) else column
+        for column in table.columns
+    ]
+    return encode_table(pa.Table.from_arrays(columns, names=table.column_names),
+                        compression)
+
+
+def current_key(redis_conn, name):
+    '''Returns the versioned key published for name, None if there is none'''
+    key = redis_conn.get(pointer_key(name))
+    return key.decode() if key else None
+
+
+def expire_version(redis_conn, data_key):
+    '''Lets a replaced manifest and its row groups expire'''
+    payload = redis_conn.get(data_key)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.expire(data_key, OLD_VERSION_TTL)
+    if payload and payload.startswith(b'{'):
+        for chunk in json.loads(payload)["chunks"]:
+            pipe.expire(chunk["key"], OLD_VERSION_TTL)
+    pipe.execute()
+
+
+def drop_frame(redis_conn, name):
+    '''Unpublishes the frame under name, letting its last version expire'''
+    key = current_key(redis_conn, name)
+    redis_conn.delete(pointer_key(name), name)
+    if key:
+        expire_version(redis_conn, key)
+
+
+def partitions_key(name):
+    '''Hash holding the partitions of name'''
+    return name + ':partitions'
+
+
+def version_key(name):
+    '''Counter bumped whenever a partition of name changes'''
+    return name + ':version'
+
+
+def partition_names(redis_conn, name):
+    '''Returns the sorted partition names of name'''
+    return sorted(part.decode() for part in redis_conn.hkeys(partitions_key(name)))
+
+
+def publish_partition(redis_conn, name, part, df):
+    '''Stores df as partition part of name, replacing any previous one'''
+    pipe = redis_conn.pipeline()
+    pipe.hset(partitions_key(name), part, encode_frame(df))
+    pipe.incr(version_key(name))
+    pipe.execute()
+    logging.info('Published %s partition %s', name, part)
+
+
+def remove_partition(redis_conn, name, part):
+    '''Drops partition part of name, if present'''
+    if redis_conn.hdel(partitions_key(name), part):
+        redis_conn.incr(version_key(name))
+        logging.info('Removed %s partition %s', name, part)
+
+
+def expire_partitions(redis_conn, name, before):
+    '''Drops the partitions of name whose names sort before before'''
+    expired = [part for part in partition_names(redis_conn, name) if part < before]
+    if expired:
+        pipe = redis_conn.pipeline()
+        pipe.hdel(partitions_key(name), *expired)
+        pipe.incr(version_key(name))
+        pipe.execute()
+        logging.info('Expired %s partitions %s', name, ', '.join(expired))
+    return expired
+
+
+def drop_partitions(redis_conn, name):
+    '''Removes all partitions of name and its version counter'''
+    redis_conn.delete(partitions_key(name), version_key(name))
@@ -0,0 +1,178 @@
+'''
+Daily range partitions of the reporting fact tables.
+
+reporting.<table> is partitioned by RANGE (date_added) with one
+partition per day, named <table>_pYYYYMMDD.  Loads create the
+partition of their day first, and retention detaches and drops whole
+partitions instead of deleting rows, so purging leaves no bloat behind
+and date filters only scan the partitions they need.
+
+An existing unpartitioned table is migrated once: it is renamed, its
+rows are copied into the partitions of the new table, ids included,
+and it is dropped, all in one transaction.
+'''
+import logging
+from datetime import date, datetime, timedelta
+import psycopg2
+from psycopg2 import sql as pgsql
+
+SUFFIX = '_p'
+
+
+def partition_name(table, day):
+    '''Name of the partition of table holding day'''
+    return '%s%s%s' % (table, SUFFIX, day.strftime('%Y%m%d'))
+
+
+def as_date(day):
+    '''Accepts dates, datetimes and YYYY-MM-DD strings'''
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, date):
+        return day
+    return date.fromisoformat(str(day))
+
+
+def relkind(cursor, table):
+    '''pg_class relkind of reporting.table, None if it does not exist'''
+    cursor.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+        ('reporting.' + table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def create_partition(cursor, table, day):
+    '''Creates the partition of table for day unless it exists'''
+    day = as_date(day)
+    cursor.execute(pgsql.SQL(
+        "CREATE TABLE IF NOT EXISTS reporting.{} PARTITION OF reporting.{} "
+        "FOR VALUES FROM (%s) TO (%s)").format(
+            pgsql.Identifier(partition_name(table, day)), pgsql.Identifier(table)),
+        (day, day + timedelta(days=1)))
+
+
+def clear_partition(cursor, table, day):
+    '''
+    Deletes the rows of the partition of table for day within the
+    current transaction, so a rerun of a loaded day replaces it.  Unlike
+    TRUNCATE it does not lock readers out while the load runs.
+    '''
+    cursor.execute(pgsql.SQL("DELETE FROM reporting.{}").format(
+        pgsql.Identifier(partition_name(table, as_date(day)))))
+    return cursor.rowcount
+
+
+def ensure_partitioned(conn, table, columns_ddl, columns):
+    '''
+    Creates reporting.table partitioned by date_added, with columns_ddl
+    and an id BIGSERIAL, migrating the rows of an unpartitioned table
+    of the same name.  columns are the data columns copied over.
+    Returns True on success.
+    '''
+    legacy = table + '_legacy'
+    create = pgsql.SQL(
+        "CREATE TABLE IF NOT EXISTS reporting.{} ({}, id BIGSERIAL) "
+        "PARTITION BY RANGE (date_added)").format(
+            pgsql.Identifier(table), pgsql.SQL(columns_ddl))
+    try:
+        with conn.cursor() as cursor:
+            kind = relkind(cursor, table)
+            if kind == 'r':
+                logging.info('Migrating reporting.%s to daily partitions', table)
+                cursor.execute(pgsql.SQL(
+                    "ALTER TABLE reporting.{} ADD COLUMN IF NOT EXISTS id BIGSERIAL; "
+                    "ALTER TABLE reporting.{} RENAME TO {}; "
+                    "DROP INDEX IF EXISTS reporting.{}, reporting.{}").format(
+                        pgsql.Identifier(table), pgsql.Identifier(table),
+                        pgsql.Identifier(legacy), pgsql.Identifier(table + '_id_idx'),
+                        pgsql.Identifier(table + '_date_added_idx')))
+            if kind != 'p':
+                cursor.execute(create)
+                cursor.execute(pgsql.SQL(
+                    "CREATE INDEX IF NOT EXISTS {} ON reporting.{} (id)").format(
+                        pgsql.Identifier(table + '_id_idx'), pgsql.Identifier(table)))
+            if kind == 'r':
+                cursor.execute(pgsql.SQL(
+                    "SELECT DISTINCT date_added FROM reporting.{}").format(
+                        pgsql.Identifier(legacy)))
+                for (day,) in cursor.fetchall():
+                    create_partition(cursor, table, day)
+                column_list = pgsql.SQL(', ').join(
+                    pgsql.Identifier(column) for column in columns + ['id'])
+                cursor.execute(pgsql.SQL(
+                    "INSERT INTO reporting.{table} ({columns}) "
+                    "SELECT {columns} FROM reporting.{legacy}").format(
+                        table=pgsql.Identifier(table), columns=column_list,
+                        legacy=pgsql.Identifier(legacy)))
+                logging.info('Migrated %s rows into reporting.%s', cursor.rowcount, table)
+                cursor.execute(pgsql.SQL(
+                    "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    "COALESCE(max(id), 0) + 1, false) FROM reporting.{}; "
+                    "DROP TABLE reporting.{}").format(
+                        pgsql.Identifier(table), pgsql.Identifier(legacy)),
+                    ('reporting.' + table,))
+        conn.commit()
+    except psycopg2.Error as error:
+        conn.rollback()
+        logging.error(error)
+        return False
+    return True
+
+
+def ensure_partitions(conn, table, days):
+    '''Creates the partitions of table for days and commits'''
+    try:
+        with conn.cursor() as cursor:
+            for day in days:
+                create_partition(cursor, table, day)
+        conn.commit()
+    except psycopg2.Error as error:
+        conn.rollback()
+        logging.error(error)
+        return False
+    return True
+
+
+def partition_days(cursor, table):
+    '''Returns {day: partition name} for the daily partitions of table'''
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)", ('reporting.' + table,))
+    prefix = table + SUFFIX
+    days = {}
+    for (name,) in cursor.fetchall():
+        if name.startswith(prefix):
+            try:
+                days[datetime.strptime(name[len(prefix):], '%Y%m%d').date()] = name
+            except ValueError:
+                continue
+    return days
+
+
+def drop_partitions_before(conn, table, before):
+    '''
+    Retention: detaches and drops the partitions of table holding days
+    before before.  Returns the dropped partition names, False on failure.
+    '''
+    before = as_date(before)
+    dropped = []
+    try:
+        with conn.cursor() as cursor:
+            for day, name in sorted(partition_days(cursor, table).items()):
+                if day >= before:
+                    continue
+                cursor.execute(pgsql.SQL(
+                    "ALTER TABLE reporting.{} DETACH PARTITION reporting.{}; "
+                    "DROP TABLE reporting.{}").format(
+                        pgsql.Identifier(table), pgsql.Identifier(name),
+                        pgsql.Identifier(name)))
+                dropped.append(name)
+        conn.commit()
+    except psycopg2.Error as error:
+        conn.rollback()
+        logging.error(error)
+        return False
+    if dropped:
+        logging.info('Dropped partitions %s', ', '.join(dropped))
+    return dropped
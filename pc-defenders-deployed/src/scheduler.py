@@ -0,0 +1,103 @@
+'''
+Event-driven wait for the next ETL run.
+
+Sleeps exactly until an etl job's next_run and wakes early when its
+reporting.etl_jobs row changes.  Changes arrive through Postgres
+LISTEN/NOTIFY: the etl_jobs_notify trigger publishes the conn_name of
+every inserted or updated row on the etl_jobs channel, so a "run now"
+(next_run moved to the present through the backend api) wakes the
+worker immediately without any polling.
+'''
+import time
+import select
+import logging
+from datetime import datetime
+import psycopg2
+
+CHANNEL = 'etl_jobs'
+NOTIFY_SQL = '''
+CREATE OR REPLACE FUNCTION reporting.notify_etl_jobs() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('etl_jobs', NEW.conn_name);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'etl_jobs_notify') THEN
+        CREATE TRIGGER etl_jobs_notify AFTER INSERT OR UPDATE ON reporting.etl_jobs
+            FOR EACH ROW EXECUTE FUNCTION reporting.notify_etl_jobs();
+    END IF;
+END
+$$;
+'''
+
+
+class Scheduler:
+    '''
+    Waits for an etl job to become due.
+    Holds a dedicated autocommit connection listening on CHANNEL.
+    '''
+
+    def __init__(self, params_dict, etl_name, max_sleep=3600):
+        self.params_dict = params_dict
+        self.etl_name = etl_name
+        self.max_sleep = max_sleep
+        self.conn = None
+
+    def listen(self):
+        '''
+        Connects, with retry, and starts listening.  Returns True when a
+        new connection was made, notifications may have been missed.
+        '''
+        if self.conn is not None and not self.conn.closed:
+            return False
+        while True:
+            try:
+                conn = psycopg2.connect(**self.params_dict)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute('LISTEN ' + CHANNEL)
+                break
+            except psycopg2.OperationalError as error:
+                logging.error(error)
+                time.sleep(5)
+        logging.info('Listening for etl job changes on %s', CHANNEL)
+        self.conn = conn
+        return True
+
+    def close(self):
+        '''Stops listening'''
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    def wait_until(self, next_run):
+        '''
+        Blocks until next_run has passed or the job's row changed.
+        Returns 'due' or 'changed'; on 'changed' the caller should
+        re-read the job's attributes.
+        '''
+        while True:
+            remaining = (next_run - datetime.now()).total_seconds()
+            if remaining <= 0:
+                return 'due'
+            if self.listen():
+                return 'changed'
+            logging.info('Sleeping until %s unless %s changes',
+                         next_run, self.etl_name)
+            try:
+                readable, _, _ = select.select(
+                    [self.conn], [], [], min(remaining, self.max_sleep))
+                if not readable:
+                    continue
+                self.conn.poll()
+            except (psycopg2.Error, OSError) as error:
+                logging.error(error)
+                self.close()
+                continue
+            payloads = {notify.payload for notify in self.conn.notifies}
+            self.conn.notifies.clear()
+            if self.etl_name in payloads:
+                logging.info('Etl job %s changed', self.etl_name)
+                return 'changed'
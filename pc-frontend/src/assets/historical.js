@@ -0,0 +1,143 @@
+/*
+ * Client-side charts of the deployed:_historical page.
+ *
+ * The page ships the defenders rollup once to the rollup_store as
+ * dictionary-encoded columns (values plus one code per row) and a total
+ * per row.  Every filter change is handled here: rows are filtered by
+ * account, version and date range, daily totals are bucketed by day,
+ * week or month, and both stacked bar figures are rebuilt without a
+ * server round trip.
+ */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    historical: {
+        build_charts: function (store, accounts, versions, dateRange, granularity) {
+            if (!store || !store.total || store.total.length === 0) {
+                return [barFigure([], 'date_added'), barFigure([], 'accountID')];
+            }
+            const accountOk = allowed(store.accountID.values, accounts);
+            const versionOk = allowed(store.version.values, versions);
+            const dates = store.date_added.values;
+            let first = null;
+            let last = null;
+            if (dateRange && dateRange.length === 2 && dateRange[0] && dateRange[1]) {
+                first = dateRange[0].slice(0, 10);
+                last = dateRange[1].slice(0, 10);
+            }
+            const dateOk = dates.map(d => (!first || d >= first) && (!last || d <= last));
+
+            // Sum the selected rows per day and category
+            const daily = new Map();
+            const rows = [];
+            let latest = null;
+            for (let i = 0; i < store.total.length; i++) {
+                const dateCode = store.date_added.codes[i];
+                if (!accountOk[store.accountID.codes[i]] || !versionOk[store.version.codes[i]]
+                        || !dateOk[dateCode]) {
+                    continue;
+                }
+                rows.push(i);
+                const date = dates[dateCode];
+                if (latest === null || date > latest) {
+                    latest = date;
+                }
+                const key = date + '\u0000' + store.category.values[store.category.codes[i]];
+                daily.set(key, (daily.get(key) || 0) + store.total[i]);
+            }
+
+            // Bucket the daily totals, wider buckets average the days they hold
+            const days = Array.from(daily.keys()).map(key => key.split('\u0000')[0]).sort();
+            const bucketBy = pickGranularity(days[0], days[days.length - 1], granularity || 'auto');
+            const buckets = new Map();
+            daily.forEach(function (total, key) {
+                const parts = key.split('\u0000');
+                const bucketKey = bucketStart(parts[0], bucketBy) + '\u0000' + parts[1];
+                const bucket = buckets.get(bucketKey) || {sum: 0, days: 0};
+                bucket.sum += total;
+                bucket.days += 1;
+                buckets.set(bucketKey, bucket);
+            });
+            const history = [];
+            buckets.forEach(function (bucket, key) {
+                const parts = key.split('\u0000');
+                history.push({x: parts[0], category: parts[1], y: Math.round(bucket.sum / bucket.days)});
+            });
+
+            // Latest selected day by account and category
+            const current = new Map();
+            rows.forEach(function (i) {
+                if (dates[store.date_added.codes[i]] !== latest) {
+                    return;
+                }
+                const key = store.accountID.values[store.accountID.codes[i]] + '\u0000'
+                    + store.category.values[store.category.codes[i]];
+                current.set(key, (current.get(key) || 0) + store.total[i]);
+            });
+            const byAccount = [];
+            current.forEach(function (total, key) {
+                const parts = key.split('\u0000');
+                byAccount.push({x: parts[0], category: parts[1], y: total});
+            });
+
+            return [barFigure(history, 'date_added'), barFigure(byAccount, 'accountID')];
+        }
+    }
+});
+
+function allowed(values, selected) {
+    if (!selected || selected.length === 0) {
+        return values.map(() => true);
+    }
+    const picked = new Set(selected);
+    return values.map(value => picked.has(value));
+}
+
+function pickGranularity(first, last, granularity) {
+    if (granularity !== 'auto') {
+        return granularity;
+    }
+    if (!first) {
+        return 'day';
+    }
+    const span = (Date.parse(last) - Date.parse(first)) / 86400000;
+    if (span <= 62) {
+        return 'day';
+    }
+    return span <= 366 ? 'week' : 'month';
+}
+
+function bucketStart(date, granularity) {
+    if (granularity === 'month') {
+        return date.slice(0, 8) + '01';
+    }
+    if (granularity === 'week') {
+        const day = new Date(date + 'T00:00:00Z');
+        day.setUTCDate(day.getUTCDate() - (day.getUTCDay() + 6) % 7);
+        return day.toISOString().slice(0, 10);
+    }
+    return date;
+}
+
+function barFigure(points, xTitle) {
+    const traces = new Map();
+    points.sort((a, b) => (a.x < b.x ? -1 : a.x > b.x ? 1 : 0));
+    points.forEach(function (point) {
+        if (!traces.has(point.category)) {
+            traces.set(point.category, {
+                type: 'bar', name: point.category, legendgroup: point.category,
+                x: [], y: []
+            });
+        }
+        traces.get(point.category).x.push(point.x);
+        traces.get(point.category).y.push(point.y);
+    });
+    const data = Array.from(traces.keys()).sort().map(name => traces.get(name));
+    return {
+        data: data,
+        layout: {
+            barmode: 'stack',
+            legend: {title: {text: 'category'}},
+            xaxis: {title: {text: xTitle}},
+            yaxis: {title: {text: 'total'}}
+        }
+    };
+}
@@ -0,0 +1,134 @@
+'''
+Process-wide access to the dataframes published by the ETLs.
+
+All pages share one redis connection pool.  A dataset is loaded lazily
+on first use and kept in memory; after DATA_TTL seconds the next read
+compares the published version (the "<name>:current" pointer, or the
+"<name>:version" counter of partitioned data) with the one held and only
+fetches and decodes the frame again when it changed.  Until the ETL has
+published anything a dataset reads as an empty frame.
+'''
+import os
+import time
+import logging
+import threading
+import pandas as pd
+import pyarrow as pa
+import redis
+from df_cache import (current_key, load_frame, load_manifest, load_partitions,
+                      partitions_version)
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis-cache')
+DATA_TTL = int(os.environ.get('DATA_TTL', '30'))
+REDIS_POOL = redis.ConnectionPool(host=REDIS_HOST, port=6379)
+
+
+def redis_conn():
+    '''Client on the shared connection pool'''
+    return redis.Redis(connection_pool=REDIS_POOL)
+
+
+class Dataset:
+    '''
+    A published dataframe cached in this process.
+    load(conn) returns the frame or None, version(conn) a string that
+    changes whenever the ETL publishes, None when it cannot tell.
+    '''
+
+    def __init__(self, load, version, empty_columns=()):
+        self.load = load
+        self.version = version
+        self.empty_columns = list(empty_columns)
+        self.lock = threading.Lock()
+        self.frame = None
+        self.loaded_version = None
+        self.checked = 0
+
+    def current_version(self):
+        '''Published version, read at most once per DATA_TTL'''
+        with self.lock:
+            self.refresh()
+            return self.loaded_version
+
+    def get(self):
+        '''Returns the frame, reloading it only when a new version is out'''
+        with self.lock:
+            self.refresh()
+            if self.frame is None:
+                return pd.DataFrame(columns=self.empty_columns)
+            return self.frame
+
+    def refresh(self):
+        if self.frame is not None and time.monotonic() - self.checked < DATA_TTL:
+            return
+        try:
+            conn = redis_conn()
+            version = self.version(conn)
+            if self.frame is None or version is None or version != self.loaded_version:
+                frame = self.load(conn)
+                if frame is not None:
+                    self.frame = frame
+                    self.loaded_version = version
+        except (redis.RedisError, pa.ArrowException) as error:
+            # Keep serving the frame held, if any
+            logging.error(error)
+        self.checked = time.monotonic()
+
+
+def frame_version(name):
+    return lambda conn: current_key(conn, name)
+
+
+def coverage_load(conn):
+    '''curr_coverage without its date_added column'''
+    manifest = load_manifest(conn, 'curr_coverage')
+    columns = None
+    if manifest:
+        columns = [c for c in manifest["columns"] if c != 'date_added']
+    df = load_frame(conn, 'curr_coverage', columns=columns)
+    return None if df is None else df.drop(columns='date_added', errors='ignore')
+
+
+def rollup_load(conn):
+    '''
+    Per-day partitions of the defenders rollup, or the full frame until
+    they are published, indexed on (accountID, version) for the filters
+    '''
+    df = load_partitions(conn, 'df_defenders')
+    if df is None:
+        df = load_frame(conn, 'df_defenders')
+    if df is None:
+        return None
+    return df.set_index(['accountID', 'version']).sort_index()
+
+
+def rollup_version(conn):
+    version = partitions_version(conn, 'df_defenders')
+    return version if version else current_key(conn, 'df_defenders')
+
+
+DATASETS = {
+    'curr_coverage': Dataset(coverage_load, frame_version('curr_coverage')),
+    'coverage_summary': Dataset(
+        lambda conn: load_frame(conn, 'coverage_summary'),
+        frame_version('coverage_summary'),
+        ['provider', 'service', 'region', 'accountid', 'runtime', 'total',
+         'defended', 'pct_defended']),
+    'coverage_trend': Dataset(
+        lambda conn: load_frame(conn, 'coverage_trend'),
+        frame_version('coverage_trend'),
+        ['date_added', 'provider', 'total', 'defended', 'pct_defended']),
+    'df_defenders': Dataset(
+        rollup_load, rollup_version,
+        ['date_added', 'category', 'version', 'connected', 'accountID', 'total']),
+}
+
+
+def get_frame(name):
+    '''Current frame of dataset name, empty until published'''
+    return DATASETS[name].get()
+
+
+def get_version(name):
+    '''Current version of dataset name, None if unknown'''
+    return DATASETS[name].current_version()
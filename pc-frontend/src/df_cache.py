@@ -0,0 +1,168 @@
+'''
+DataFrame storage in the redis cache.
+
+A frame is split into row groups of CACHE_CHUNK_ROWS rows.  Every row
+group is a redis hash ("<name>:<version>:<n>") holding one compressed
+Arrow IPC stream per column, with repetitive string columns
+dictionary-encoded.  A JSON manifest under "<name>:<version>" lists the
+columns and row groups, and the "<name>:current" pointer is swapped to
+it atomically once everything is written, so readers never see a half
+written frame.  Readers can fetch a subset of the row groups and/or
+columns.  The replaced version expires after OLD_VERSION_TTL seconds to
+let in-flight readers finish.
+
+No single redis value grows beyond one column of one row group, which
+keeps writes and reads of large frames from blocking redis.
+
+CACHE_FORMAT=pickle keeps the previous single pickled value under
+"<name>", which is also what load_frame falls back to.
+
+Append-only history can instead be kept as partitions, one field per
+partition (e.g. per day) of the "<name>:partitions" hash, so a writer
+only touches the partitions that changed.  "<name>:version" is bumped
+on every partition change.
+
+Each service carries only its part of this module: the coverage ETL
+publishes whole frames, the deployed ETL publishes partitions and the
+frontend reads both.  The storage format is shared, keep the copies
+in sync when changing it.
+'''
+import json
+import pickle
+import pyarrow as pa
+
+
+def pointer_key(name):
+    '''Key holding the versioned key currently published for name'''
+    return name + ':current'
+
+
+def decode_frame(payload):
+    '''
+    Inverse of encode_frame.  Dictionary-encoded columns come back as
+    pandas categoricals.
+    '''
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+def current_key(redis_conn, name):
+    '''Returns the versioned key published for name, None if there is none'''
+    key = redis_conn.get(pointer_key(name))
+    return key.decode() if key else None
+
+
+def load_manifest(redis_conn, name):
+    '''
+    Returns the manifest of the frame published under name, None if
+    there is none
+    '''
+    key = current_key(redis_conn, name)
+    if key is None:
+        return None
+    payload = redis_conn.get(key)
+    return json.loads(payload) if payload else None
+
+
+def read_chunks(redis_conn, manifest, columns, chunks):
+    '''
+    Fetches the requested row groups and columns in one round trip.
+    Returns None if the version expired in the meantime.
+    '''
+    selected = manifest["chunks"] if chunks is None else [
+        manifest["chunks"][index] for index in chunks]
+    pipe = redis_conn.pipeline(transaction=False)
+    for chunk in selected:
+        pipe.hmget(chunk["key"], columns)
+    tables = []
+    for values in pipe.execute():
+        if any(value is None for value in values):
+            return None
+        tables.append(pa.Table.from_arrays(
+            [pa.ipc.open_stream(value).read_all().column(0) for value in values],
+            names=columns))
+    if not tables:
+        return pa.table({column: pa.array([], pa.null()) for column in columns})
+    return pa.concat_tables(tables)
+
+
+def load_frame(redis_conn, name, columns=None, chunks=None):
+    '''
+    Returns the frame currently published under name, None if nothing
+    is cached.  columns limits the columns read, chunks the row group
+    indexes read.  Both are ignored for the pickle format.
+    '''
+    for _ in range(2):
+        key = current_key(redis_conn, name)
+        if key is None:
+            payload = redis_conn.get(name)
+            return pickle.loads(payload) if payload else None
+        payload = redis_conn.get(key)
+        if payload is None:
+            # Version expired between reading the pointer and the data
+            continue
+        if not payload.startswith(b'{'):
+            return decode_frame(payload)
+        manifest = json.loads(payload)
+        table = read_chunks(redis_conn, manifest,
+                            manifest["columns"] if columns is None else list(columns),
+                            chunks)
+        if table is not None:
+            return table.to_pandas()
+    return None
+
+
+def partitions_key(name):
+    '''Hash holding the partitions of name'''
+    return name + ':partitions'
+
+
+def version_key(name):
+    '''Counter bumped whenever a partition of name changes'''
+    return name + ':version'
+
+
+def partitions_version(redis_conn, name):
+    '''Returns the partition version of name, None if never published'''
+    version = redis_conn.get(version_key(name))
+    return version.decode() if version else None
+
+
+def load_partitions(redis_conn, name, parts=None):
+    '''
+    Returns the concatenation of the partitions of name, or only of
+    parts, in partition order.  None if name has no partitions.
+    '''
+    if parts is None:
+        payloads = redis_conn.hgetall(partitions_key(name))
+        payloads = [payloads[key] for key in sorted(payloads)]
+    else:
+        payloads = [payload for payload in redis_conn.hmget(
+            partitions_key(name), sorted(parts)) if payload is not None]
+    if not payloads:
+        return None
+    tables = [pa.ipc.open_stream(payload).read_all() for payload in payloads]
+    # An empty partition adds no rows but may carry null-typed columns
+    tables = [table for table in tables if table.num_rows] or tables[:1]
+    if any(table.schema != tables[0].schema for table in tables):
+        tables = unify_tables(tables)
+    return pa.concat_tables(tables).to_pandas()
+
+
+def unify_tables(tables):
+    '''
+    Casts tables that differ in dictionary encoding, or hold all-null
+    columns, to plain value types so they can be concatenated
+    '''
+    tables = [pa.Table.from_arrays(
+        [column.cast(column.type.value_type) if pa.types.is_dictionary(column.type)
+         else column for column in table.columns],
+        names=table.column_names) for table in tables]
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, field.type)
+    return [pa.Table.from_arrays(
+        [column.cast(types[name]) if pa.types.is_null(column.type) and name in types
+         else column for name, column in zip(table.column_names, table.columns)],
+        names=table.column_names) for table in tables]
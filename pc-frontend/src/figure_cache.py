@@ -0,0 +1,76 @@
+'''
+Memoized chart figures, shared across frontend workers.
+
+Figures are keyed by the version of the dataset they were built from
+plus the filter values that shaped them, so a publish by the ETL makes
+every older entry unreachable and it simply expires.  Entries live in
+redis for FIGURE_TTL seconds as plotly JSON, with a small in-process
+LRU in front that saves the redis round trip for hot selections.
+'''
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import redis
+from plotly.utils import PlotlyJSONEncoder
+from data_access import redis_conn
+
+FIGURE_TTL = int(os.environ.get('FIGURE_TTL', '3600'))
+LOCAL_FIGURES = int(os.environ.get('LOCAL_FIGURES', '128'))
+
+_local = OrderedDict()
+_lock = threading.Lock()
+
+
+def figure_key(name, version, params):
+    '''Redis key for the figures of name built from version with params'''
+    digest = hashlib.sha1(
+        json.dumps([version, params], sort_keys=True, default=str).encode()).hexdigest()
+    return 'figures:%s:%s' % (name, digest)
+
+
+def _local_get(key):
+    with _lock:
+        if key not in _local:
+            return None
+        _local.move_to_end(key)
+        return _local[key]
+
+
+def _local_set(key, figures):
+    with _lock:
+        _local[key] = figures
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_FIGURES:
+            _local.popitem(last=False)
+
+
+def cached_figures(name, version, params, build):
+    '''
+    Returns the figures, or other plotly JSON serializable data, build()
+    makes for params as decoded JSON, computing them only on a miss.
+    Without a known dataset version they are always built.
+    '''
+    if version is None:
+        return json.loads(json.dumps(build(), cls=PlotlyJSONEncoder))
+    key = figure_key(name, version, params)
+    figures = _local_get(key)
+    if figures is not None:
+        return figures
+    conn = redis_conn()
+    try:
+        payload = conn.get(key)
+    except redis.RedisError as error:
+        logging.error(error)
+        payload = None
+    if payload is None:
+        payload = json.dumps(build(), cls=PlotlyJSONEncoder)
+        try:
+            conn.setex(key, FIGURE_TTL, payload)
+        except redis.RedisError as error:
+            logging.error(error)
+    figures = json.loads(payload)
+    _local_set(key, figures)
+    return figures
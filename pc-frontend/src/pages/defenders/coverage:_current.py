@@ -2,37 +2,190 @@
 Duilds reporting page for Defender deployments
 '''
 
-from dash import register_page, html, dash_table
-from direct_redis import DirectRedis
+import pandas as pd
+from dash import register_page, dcc, html, dash_table, Input, Output, State, callback
+from data_access import get_frame
+import plotly.express as px
 
 register_page(__name__, icon="fa:table")
 
+PAGE_SIZE = 25
+FILTER_OPERATORS = [
+    ['ge ', '>= '], ['le ', '<= '], ['lt ', '< '], ['gt ', '> '], ['ne ', '!= '],
+    ['eq ', '= '], ['contains '], ['datestartswith '],
+]
+
 
 def get_data():
-    redis_conn = DirectRedis(host='redis-cache', port=6379)
-    df = redis_conn.get('curr_coverage')
+    return get_frame('curr_coverage')
+
+
+def get_summary():
+    '''
+    Defended percentage by provider and service of the latest run, and
+    the trend by provider across retained runs, from the small
+    aggregates published by the coverage ETL
+    '''
+    summary = get_frame('coverage_summary')
+    trend = get_frame('coverage_trend')
+    by_service = summary.groupby(['provider', 'service'], observed=True)[
+        ['total', 'defended']].sum(numeric_only=False).reset_index()
+    if not by_service.empty:
+        by_service['pct_defended'] = (
+            by_service['defended'] / by_service['total'] * 100).round(1)
+    return by_service, trend
+
+
+def split_filter_part(filter_part):
+    '''
+    Splits one "{column} operator value" clause of a DataTable filter
+    query into column name, operator and value
+    '''
+    name_end = filter_part.find('}')
+    if filter_part.find('{') < 0 or name_end < 0:
+        return None, None, None
+    name = filter_part[filter_part.find('{') + 1:name_end]
+    rest = filter_part[name_end + 1:].strip() + ' '
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if not rest.startswith(operator):
+                continue
+            value_part = rest[len(operator):].strip()
+            if value_part and value_part[0] == value_part[-1] and value_part[0] in "'\"`":
+                value = value_part[1:-1].replace('\\' + value_part[0], value_part[0])
+            else:
+                try:
+                    value = float(value_part)
+                except ValueError:
+                    value = value_part
+            return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def filter_frame(df, filter_query):
+    '''Applies a DataTable filter query to df'''
+    for filter_part in (filter_query or '').split(' && '):
+        name, operator, value = split_filter_part(filter_part)
+        if name not in df.columns:
+            continue
+        column = df[name]
+        if isinstance(value, float) and column.dtype != bool and \
+                not pd.api.types.is_numeric_dtype(column):
+            value = value_text(value)
+        if operator in ('contains', 'datestartswith'):
+            text = column.astype(str)
+            mask = text.str.contains(str(value), case=False, regex=False) \
+                if operator == 'contains' else text.str.startswith(str(value))
+        else:
+            if column.dtype == bool and isinstance(value, str):
+                value = value.lower() == 'true'
+            compare = {'eq': '__eq__', 'ne': '__ne__', 'lt': '__lt__', 'le': '__le__',
+                       'gt': '__gt__', 'ge': '__ge__'}[operator]
+            try:
+                mask = getattr(column, compare)(value)
+            except TypeError:
+                mask = getattr(column.astype(str), compare)(str(value))
+        df = df.loc[mask.fillna(False).astype(bool)]
     return df
 
 
-df = get_data()
-df.drop('date_added', axis=1, inplace=True)
-
-
-layout = html.Div([
-    dash_table.DataTable(
-        id='datatable-interactivity',
-        columns=[
-            {"name": i, "id": i, "deletable": False, "selectable": True} for i in df.columns
-        ],
-        data=df.to_dict('records'),
-        editable=True,
-        filter_action="native",
-        sort_action="native",
-        sort_mode="multi",
-        page_action="native",
-        page_current=0,
-        page_size=25,
-        export_format="csv",
-    ),
-    html.Div(id='datatable-interactivity-container')
-])
+def value_text(value):
+    '''Filter numbers typed against text columns, e.g. account IDs'''
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def sort_key(column):
+    '''
+    Categoricals come back from the cache with their categories in first
+    seen order, sort them by value instead of by category code
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.reorder_categories(
+            column.cat.categories.sort_values(), ordered=True)
+    return column
+
+
+def sort_frame(df, sort_by):
+    '''Applies the DataTable sort_by list to df'''
+    sort_by = [col for col in sort_by or [] if col['column_id'] in df.columns]
+    if not sort_by:
+        return df
+    return df.sort_values(
+        [col['column_id'] for col in sort_by],
+        ascending=[col['direction'] == 'asc' for col in sort_by],
+        na_position='last',
+        kind='mergesort',
+        key=sort_key,
+    )
+
+
+def layout():
+    '''Built per page load, the coverage table is paged server-side'''
+    df = get_data()
+    df_summary, df_trend = get_summary()
+    return html.Div([
+        dash_table.DataTable(
+            id='coverage-summary',
+            columns=[{"name": i, "id": i} for i in df_summary.columns],
+            data=df_summary.to_dict('records'),
+            sort_action="native",
+        ),
+        dcc.Graph(
+            id='coverage-trend',
+            figure=px.line(df_trend, x="date_added", y="pct_defended", color="provider"),
+        ),
+        dash_table.DataTable(
+            id='datatable-interactivity',
+            columns=[
+                {"name": i, "id": i, "deletable": False, "selectable": True} for i in df.columns
+            ],
+            editable=True,
+            filter_action="custom",
+            filter_query='',
+            sort_action="custom",
+            sort_mode="multi",
+            sort_by=[],
+            page_action="custom",
+            page_current=0,
+            page_size=PAGE_SIZE,
+        ),
+        html.Div(id='datatable-interactivity-container'),
+        html.Button("Export CSV", id='coverage-export-button'),
+        dcc.Download(id='coverage-export'),
+    ])
+
+
+@ callback(
+    [Output(component_id='datatable-interactivity', component_property='data')],
+    [Output(component_id='datatable-interactivity', component_property='page_count')],
+    [Output(component_id='datatable-interactivity-container', component_property='children')],
+    [Input(component_id='datatable-interactivity', component_property='page_current')],
+    [Input(component_id='datatable-interactivity', component_property='page_size')],
+    [Input(component_id='datatable-interactivity', component_property='sort_by')],
+    [Input(component_id='datatable-interactivity', component_property='filter_query')],
+)
+def update_table(page_current, page_size, sort_by, filter_query):
+    '''Returns only the requested page of the filtered, sorted coverage'''
+    df = sort_frame(filter_frame(get_data(), filter_query), sort_by)
+    page_size = page_size or PAGE_SIZE
+    page_count = max(-(-len(df.index) // page_size), 1)
+    page_current = min(page_current or 0, page_count - 1)
+    page = df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    total = html.Span(f"{len(df.index)} matching resources")
+    return page.to_dict('records'), page_count, total
+
+
+@ callback(
+    Output(component_id='coverage-export', component_property='data'),
+    [Input(component_id='coverage-export-button', component_property='n_clicks')],
+    [State(component_id='datatable-interactivity', component_property='sort_by')],
+    [State(component_id='datatable-interactivity', component_property='filter_query')],
+    prevent_initial_call=True,
+)
+def export_table(n_clicks, sort_by, filter_query):
+    '''
+    Every filtered, sorted coverage row as CSV, the table itself only
+    holds the page on screen
+    '''
+    df = sort_frame(filter_frame(get_data(), filter_query), sort_by)
+    return dcc.send_data_frame(df.to_csv, 'coverage.csv', index=False)
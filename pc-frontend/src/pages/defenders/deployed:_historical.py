@@ -3,22 +3,40 @@ Duilds reporting page for Defender deployments
 '''
 
 import datetime
-from dash import register_page, dcc, html, Input, Output, callback, dash_table
+from dash import register_page, dcc, html, Input, Output, callback, clientside_callback, \
+    ClientsideFunction, dash_table
 import dash_mantine_components as dmc
-from direct_redis import DirectRedis
-import plotly.express as px
+from data_access import get_frame, get_version
+from figure_cache import cached_figures
 import numpy
+import pandas as pd
 
 register_page(__name__, icon="fa:bar-chart")
 
+GRANULARITIES = ['auto', 'day', 'week', 'month']
+ROLLUP_COLUMNS = ['date_added', 'category', 'version', 'accountID']
+
 
 def get_data():
-    redis_conn = DirectRedis(host='redis-cache', port=6379)
-    df = redis_conn.get('df_all_defenders')
+    '''Defenders rollup indexed on (accountID, version), summed for charts'''
+    df = get_frame('df_defenders')
+    if 'accountID' in df.columns:
+        # Not published yet
+        df = df.set_index(['accountID', 'version'])
     return df
 
 
-df = get_data()
+def compact_rollup(df):
+    '''
+    Columnar, dictionary-encoded copy of the rollup for the browser:
+    per dimension the distinct values and one code per row, plus totals
+    '''
+    df = df.reset_index()
+    payload = {'total': df['total'].astype(int).tolist()}
+    for column in ROLLUP_COLUMNS:
+        codes, values = pd.factorize(df[column].astype(str), sort=True)
+        payload[column] = {'values': values.tolist(), 'codes': codes.tolist()}
+    return payload
 
 
 def get_multiselect(identifier, pick_list):
@@ -38,6 +56,21 @@ layout = html.Div([
         dmc.Space(h=20),
         dmc.Text("Account Selector"),
         html.Div(id='account_multiselect'),
+        dmc.Space(h=20),
+        dmc.Group([
+            dmc.DateRangePicker(
+                id='date_range',
+                label="Date Range",
+                placeholder='All retained days',
+                clearable=True,
+                style={"width": 330},
+            ),
+            dmc.SegmentedControl(
+                id='granularity',
+                value='auto',
+                data=[{"value": x, "label": x.capitalize()} for x in GRANULARITIES],
+            ),
+        ], align='flex-end'),
         html.Div([
             dcc.Graph(id='historical_deployment'),
         ]),
@@ -45,6 +78,7 @@ layout = html.Div([
             dcc.Graph(id='deployed_by_account'),
         ]),
         html.Div(id='latest-timestamp', style={"padding": "20px"}),
+        dcc.Store(id='rollup_store'),
         dcc.Interval(
             id='interval-component',
             interval=3600 * 1000,
@@ -58,42 +92,30 @@ layout = html.Div([
     [Output(component_id='latest-timestamp', component_property='children')],
     [Output(component_id='version_multiselect', component_property='children')],
     [Output(component_id='account_multiselect', component_property='children')],
+    [Output(component_id='rollup_store', component_property='data')],
     [Input('interval-component', 'n_intervals')]
 )
 def update_timestamp(interval):
     df = get_data()
-    all_versions = numpy.sort(df.version.unique())
-    all_accounts = numpy.sort(df.accountID.unique())
+    all_versions = numpy.sort(df.index.unique(level='version'))
+    all_accounts = numpy.sort(df.index.unique(level='accountID'))
     version_multiselect = get_multiselect('versions', all_versions)
     account_multiselect = get_multiselect('accounts', all_accounts)
     timestamp = [html.Span(f"Last updated: {datetime.datetime.now()}")]
-    return timestamp, version_multiselect, account_multiselect
+    rollup = cached_figures(
+        'historical_rollup', get_version('df_defenders'), [], lambda: compact_rollup(df))
+    return timestamp, version_multiselect, account_multiselect, rollup
 
 
-@ callback(
+# Filtering, bucketing and both figures run in the browser,
+# see assets/historical.js
+clientside_callback(
+    ClientsideFunction(namespace='historical', function_name='build_charts'),
     [Output(component_id='historical_deployment', component_property='figure')],
     [Output(component_id='deployed_by_account', component_property='figure')],
+    [Input(component_id='rollup_store', component_property='data')],
     [Input(component_id='accounts', component_property='value')],
     [Input(component_id='versions', component_property='value')],
+    [Input(component_id='date_range', component_property='value')],
+    [Input(component_id='granularity', component_property='value')],
 )
-def update_charts(accounts, versions):
-    if accounts == None or len(accounts) == 0:
-        accounts = []
-        account_mask = ~df["accountID"].isin(accounts)
-    else:
-        account_mask = df["accountID"].isin(accounts)
-    if versions == None or len(versions) == 0:
-        versions = []
-        version_mask = ~df["version"].isin(versions)
-    else:
-        version_mask = df["version"].isin(versions)
-    df_historical = (df[(account_mask & version_mask)]).groupby(
-        ['date_added', 'category'])['date_added'].count().reset_index(name='total')
-    fig1 = px.bar(df_historical, x="date_added", y="total",
-                  color="category", barmode="stack")
-    date_mask = df['date_added'] == (df["date_added"].max())
-    df_account_current = (df[(account_mask & version_mask & date_mask)]).groupby(
-        ['accountID', 'category'])['accountID'].count().reset_index(name='total')
-    fig2 = px.bar(df_account_current, x="accountID", y="total",
-                  color="category", barmode="stack")
-    return fig1, fig2